@@ -0,0 +1,44 @@
+# -*- coding: iso-8859-1 -*-
+"""
+    MoinMoin - SiteContentsTree event handler
+
+    Keeps the page tree journal of the SiteContents macro up to date:
+    each time a page is saved, renamed, copied, reverted or deleted,
+    the names of the changed pages are recorded, so that the macro
+    only evaluates its Pages expression again for them (and their
+    parents) instead of for the whole wiki.
+
+    Install it along with the SiteContents macro, in the events plugin
+    directory of the wiki. Without it, the macro recomputes its page
+    list after each change of the edit-log.
+
+    @license: GNU GPL, see COPYING for details.
+"""
+
+from MoinMoin import events, wikiutil
+
+
+def handle(event):
+    if isinstance(event, events.PageRenamedEvent):
+        page_names = [event.page.page_name, event.old_page.page_name]
+    elif isinstance(event, (events.PageChangedEvent,
+                            events.TrivialPageChangedEvent,
+                            events.PageDeletedEvent,
+                            events.PageCopiedEvent)):
+        page_names = [event.page.page_name]
+    elif isinstance(event, events.PageRevertedEvent):
+        page_names = [event.pagename]
+    elif isinstance(event, (events.FileAttachedEvent,
+                            events.FileRemovedEvent)):
+        # no page changed, but the edit-log moved
+        page_names = []
+    else:
+        return
+
+    request = event.request
+    try:
+        tree_changed = wikiutil.importPlugin(request.cfg, 'macro',
+                                             'SiteContents', 'tree_changed')
+    except (wikiutil.PluginMissingError, wikiutil.PluginAttributeError):
+        return
+    tree_changed(request, page_names)
@@ -6,6 +6,12 @@ A macro to list category pages, with hints on tagged pages (such as
 the number of pages belonging to that category). It can also generate
 a tag cloud.
 
+Installation: this macro is no longer standalone. It shares the page
+list, read rights, page classification, Pages evaluation and persistent
+indexes of the SiteContents macro, so SiteContents.py must be installed
+in the same macro plugin directory; without it, every call fails with
+an error saying so.
+
 $Revision: 193 $
 $Id: CategoryList.py 193 2010-05-14 12:31:05Z pascal $
 
@@ -109,10 +115,44 @@ General keywords:
                         with the string specified by CategoryWord.
                         Default: omitted                        
 
+  Categories          = 'EXPRESSION'
+                        Optional boolean expression of category names,
+                        with and, or, not and parentheses, to limit the
+                        search to the pages it matches, e.g.
+                        'Foo and Bar and not Obsolete'. The names may
+                        or may not begin with CategoryWord, and are
+                        quoted if they are not identifiers.
+                        Default: omitted
+
   Reverse             = 0|1
                         Reverses the sort order.
                         Default: 0 (forward sorting)
 
+  ContainsIndex       = 0|1
+                        If 1, contains() only searches the pages
+                        that the trigram index of the SiteContents
+                        macro cannot rule out.
+                        Default: 0
+
+  Index               = 0|1
+                        If 1, the categories of the pages are taken
+                        from an index kept in the wiki cache, instead
+                        of searching the whole wiki for CategoryWord.
+                        The index is built once per CategoryWord, then
+                        updated from the edit-log for the pages
+                        changed since.
+                        Default: 0
+
+  TailScan            = 0|1
+                        If 1, the categories of a page are only looked
+                        for after its last '----' line, as the last
+                        4 KB of its file are read, instead of in the
+                        whole page. Pages with no such line in their
+                        last 4 KB are read entirely. Also applies to
+                        the Index. Categories placed before the last
+                        '----' line, e.g. above a footer, are missed.
+                        Default: 0
+
 Keywords can be also given in upper or lower cases, or abbreviated.
 Example: Pages, PAGES, pages, p, etc.
 
@@ -152,7 +192,7 @@ DEF_FP  =  " 1. [[%(page)s|%(pagelastname)s]] ~-(''%(categorynames)s'')-~"
 
 
 # Imports
-import re, sys, StringIO, urllib, sha, math
+import re, sys, StringIO, urllib, sha, math, ast
 from string import ascii_lowercase, maketrans
 from MoinMoin import config, wikiutil, version, search
 from MoinMoin.Page import Page
@@ -250,8 +290,141 @@ def _re_compile(text, name):
         raise _Error("%s for regex argument %s: '%s'" % (msg, name, text))
 
 
-def _get_all_pages(request):
-    return request.rootpage.getPageList()
+def _site_contents(cfg, name):
+    """Returns NAME from the SiteContents macro, which this macro shares
+    its page list helpers with"""
+    try:
+        return wikiutil.importPlugin(cfg, 'macro', 'SiteContents', name)
+    except (wikiutil.PluginMissingError, wikiutil.PluginAttributeError):
+        raise _Error("the SiteContents macro must be installed in the "
+                     "same macro plugin directory")
+
+
+def _eval_categories(expr, tags, category_word, pages):
+
+    """Returns the set of the PAGES whose tags satisfy EXPR, a boolean
+    expression of category names (with or without CATEGORY_WORD) and
+    of the operators and, or, not. TAGS gives the pages carrying each
+    tag. The expression is evaluated with set operations over the
+    pages of each category among PAGES"""
+
+    def invalid(reason):
+        return _Error("""invalid expression for Categories argument: %s
+                <br>(reason: %s)
+                """ % (expr, reason))
+
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+    except (SyntaxError, TypeError, ValueError), msg:
+        raise invalid(msg)
+
+    pages = set(pages)
+
+    def category(cat):
+        if not cat.startswith(category_word):
+            cat = category_word + cat
+        return tags.get(cat, set()) & pages
+
+    def evaluate(node):
+        if isinstance(node, ast.BoolOp):
+            result = evaluate(node.values[0])
+            for value in node.values[1:]:
+                if isinstance(node.op, ast.And):
+                    result = result & evaluate(value)
+                else:
+                    result = result | evaluate(value)
+            return result
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return pages - evaluate(node.operand)
+        if isinstance(node, ast.Name):
+            return category(unicode(node.id))
+        if isinstance(node, ast.Str):
+            if isinstance(node.s, unicode):
+                return category(node.s)
+            return category(node.s.decode(config.charset))
+        raise invalid("only category names, and, or, not and parentheses "
+                      "are allowed")
+
+    return evaluate(tree.body)
+
+
+# with TailScan, the number of bytes read at the end of a page, where
+# the categories are looked for after the last '----' line
+TAIL_SCAN_SIZE = 4096
+
+RULE_RX = re.compile(r"^-{4,}[ \t]*$", re.M)
+
+def _tag_rx(category_word):
+    """Returns the regex the search of the macro uses for the tags"""
+    return re.compile(r"\b%s\S+\b" % category_word, re.U)
+
+
+def _page_tail(page):
+    """Returns the text after the last '----' line of a page, if found
+    in the last TAIL_SCAN_SIZE bytes of its file, or None"""
+    try:
+        f = open(page.get_rev()[0], 'rb')
+    except IOError:
+        return None
+    try:
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(max(0, size - TAIL_SCAN_SIZE))
+        data = f.read()
+    finally:
+        f.close()
+    if size > TAIL_SCAN_SIZE:
+        # drop the first line, which may have been cut anywhere, even
+        # inside a character
+        data = data[data.find("\n") + 1:]
+    text = data.decode(config.charset, 'replace').replace(u'\r', u'')
+    rules = list(RULE_RX.finditer(text))
+    if not rules:
+        return None
+    return text[rules[-1].end():]
+
+
+def _page_tags(request, tag_rx, page_name, tail=False):
+    """Returns the set of the tags found in the name and body of a page,
+    or None if it does not exist. With TAIL, only the end of the body
+    after the last '----' line is searched, if there is one"""
+    page = Page(request, page_name)
+    if not page.exists():
+        return None
+    text = None
+    if tail:
+        text = _page_tail(page)
+    if text is None:
+        text = page.get_raw_body()
+    tags = set()
+    for text in (page_name, text):
+        for match in tag_rx.finditer(text):
+            tags.add(match.group())
+    return frozenset(tags)
+
+
+def _category_index(request, category_word, tail=False):
+
+    """Returns a dict giving the set of the pages carrying each category
+    tag, from a persistent index of the tags found in the name and body
+    of each page, kept in the wiki cache dir for each category word.
+    The index is the inverted index of the SiteContents macro, brought
+    up to date from the edit-log. The tags are what the search of the
+    macro would match: '\\bWORD\\S+\\b', case-sensitive; with TAIL, in
+    the end of the pages only"""
+
+    tag_rx = _tag_rx(category_word)
+    key = category_word
+    if tail:
+        key += u"\0tail"
+    key = sha.new(key.encode(config.charset)).hexdigest()
+
+    def terms(page_name):
+        return _page_tags(request, tag_rx, page_name, tail)
+
+    index = _site_contents(request.cfg, '_InvertedIndex')(
+        request, 'categorylist', 'index-' + key, terms)
+    return index.postings()
 
 
 ###############################################################################
@@ -379,9 +552,14 @@ def _execute(macro, text):
 
     opt_category_word    = _param_get(params, 'CategoryWord',  "Category")
     opt_category         = _param_get(params, 'Category', None)
+    opt_categories       = _param_get(params, 'Categories', None)
 
     opt_reverse          = _param_get(params, 'Reverse',  0)
 
+    opt_contains_index   = _param_get(params, 'ContainsIndex', 0)
+    opt_index            = _param_get(params, 'Index', 0)
+    opt_tail_scan        = _param_get(params, 'TailScan', 0)
+
     if opt_format is None:
         if opt_bypages: opt_format = DEF_FP
         else:           opt_format = DEF_FC
@@ -435,11 +613,14 @@ def _execute(macro, text):
         def contains(what):
             if hits_dict.has_key(what):
                 hits = hits_dict[what]
+            elif contains_hits:
+                hits = set(contains_hits(macro.request, what, True))
+                hits_dict[what] = hits
             else:
                 parser = search.QueryParser(regex=1)
                 query = parser.parse_query(what)
                 results = search.searchPages(macro.request, query)
-                hits = [h.page_name for h in results.hits]
+                hits = set([h.page_name for h in results.hits])
                 hits_dict[what] = hits
             return page in hits
 
@@ -449,51 +630,80 @@ def _execute(macro, text):
         def name_is_child(what):
             return name_startswith(this_page + "/")
 
-        def has_children(what):
-            me = what+"/"
-            for p in all_pages:
-                if p.startswith(me): return True
-            return False
+        def page_flags(page):
+            if classes.has_key(page):
+                return classes[page]
+            # the page list changed since the table was computed
+            return classify_page(macro.request, special_page_rxs(cfg),
+                                 page)
+
+        cfg = macro.request.cfg
+
+        # the page list, its read rights and its classification are the
+        # ones of the SiteContents macro, shared by both macros
+        classify_page = _site_contents(cfg, '_classify_page')
+        special_page_rxs = _site_contents(cfg, '_special_page_rxs')
+        system_flag = _site_contents(cfg, 'PAGE_SYSTEM')
+        special_flag = _site_contents(cfg, 'PAGE_SPECIAL')
 
-        all_pages = _get_all_pages(macro.request)
+        all_pages = _site_contents(cfg, '_get_all_pages')(macro.request)
+        index = _site_contents(cfg, '_PageIndex')(all_pages)
 
         hits = []
         hits_dict = {}
         nm_dict = {}
 
-        cfg = macro.request.cfg
-
-        for page in all_pages:
-            is_syspage = wikiutil.isSystemPage(macro.request, page)
-            is_special = ( \
-                name_matches(cfg.page_category_regex) or \
-                name_matches(cfg.page_dict_regex) or \
-                name_matches(cfg.page_group_regex) or \
-                name_matches(cfg.page_template_regex) \
-                ) and not "/" in page
-            is_regular = not (is_syspage or is_special)
-
-            locs = {
-                # functions:
-                'name_contains': name_contains,
-                'name_is': name_is,
-                'name_startswith': name_startswith,
-                'name_endswith': name_endswith,
-                'name_matches': name_matches,
-                'contains': contains,
-                # vars (for each page we must rebuild this dict for them):
-                'regular': is_regular,
-                'system' : is_syspage,
-                'this_page' : page == this_page,
-                'others' : page != this_page,
-                'all' : True,
-                'this': name_is_this(page),
-                'children': name_is_child(page),
-                'has_child': has_children(page),
-                }
+        # the trigram index is the one of the SiteContents macro
+        contains_hits = None
+        if opt_contains_index:
+            contains_hits = _site_contents(cfg, 'contains_hits')
+
+        classes = _site_contents(cfg, '_get_page_classes')(macro.request)
+
+        # Pages is checked as SiteContents does: only its documented
+        # functions and variables may be named
+        compile_pages = _site_contents(cfg, '_compile_pages')
+        compile_error = _site_contents(cfg, '_Error')
+        try:
+            code = compile_pages(arg_pages)
+        except compile_error, msg:
+            raise _Error(msg)
+
+        # the variables are only computed for the current page when the
+        # expression actually uses them
+        locs = _site_contents(cfg, '_PagesLocals')({
+            # functions:
+            'name_contains': name_contains,
+            'name_is': name_is,
+            'name_startswith': name_startswith,
+            'name_endswith': name_endswith,
+            'name_matches': name_matches,
+            'contains': contains,
+            }, {
+            # vars (evaluated for the page being examined):
+            'regular': lambda: not page_flags(page) & (system_flag|special_flag),
+            'system' : lambda: bool(page_flags(page) & system_flag),
+            'this_page' : lambda: page == this_page,
+            'others' : lambda: page != this_page,
+            'all' : lambda: True,
+            'this': lambda: name_is_this(page),
+            'children': lambda: name_is_child(page),
+            'has_child': lambda: index.has_children(page),
+            })
+
+        # only evaluate the expression on the pages its name predicates
+        # and page kinds leave
+        plan_pages = _site_contents(cfg, '_plan_pages')
+        pages = plan_pages(arg_pages, index, this_page,
+                           macro.request.page.page_name, page_flags)
+        if pages is None:
+            pages = all_pages
+        else:
+            pages = sorted(pages)
 
+        for page in pages:
             try:
-                if not eval(arg_pages, {'__builtins__': []}, locs):
+                if not eval(code, {'__builtins__': []}, locs):
                     continue
             except Exception, msg:
                 raise _Error("""invalid expression for Pages argument: %s
@@ -518,34 +728,70 @@ def _execute(macro, text):
     if opt_bypages == 2:
         for p in hits: pages_hits[p] = set()
 
-    parser = search.QueryParser(regex=1, case=1) # case-sensitive
-    query = parser.parse_query(content_regex)
-    results = search.searchPages(macro.request, query)
     is_name_rx = re.compile('^\w+$')
-    for hit in results.hits:
 
-        # if particular category specified and not here, do not keep
-        # this hit
-        if opt_category:
-            found = False
+    hits_set = set(hits)
+
+    # The pages carrying each tag: from the category index, from the
+    # ends of the pages, or from a search
+    if opt_index:
+        tags = _category_index(macro.request, opt_category_word,
+                               opt_tail_scan)
+    elif opt_tail_scan:
+        tags = {}
+        tag_rx = _tag_rx(opt_category_word)
+        for page in hits:
+            for tag in _page_tags(macro.request, tag_rx, page, True) or ():
+                if not tags.has_key(tag):
+                    tags[tag] = set()
+                tags[tag].add(page)
+    else:
+        parser = search.QueryParser(regex=1, case=1) # case-sensitive
+        query = parser.parse_query(content_regex)
+        if macro.request.cfg.xapian_search:
+            results = search.searchPages(macro.request, query)
+        elif hits:
+            # only search the listed pages
+            pages = [{'pagename': page, 'attachment': '', 'wikiname': 'Self'}
+                     for page in sorted(hits)]
+            results = search.MoinSearch(macro.request, query,
+                                        pages=pages).run()
+        else:
+            results = None
+        tags = {}
+        for hit in results and results.hits or []:
+            if hit.page_name not in hits_set: continue
             for match in hit.get_matches():
-                cat = match.re_match.group()
-                if category_rx.match(cat): found = True
-            if not found: continue
-
-        # keep this hit and remember to what it belongs
-        for match in hit.get_matches():
-            if hit.page_name not in hits: continue
-            cat = match.re_match.group()
-            if not is_name_rx.match(cat): continue
-            # remember category
-            if not categories_hits.has_key(cat):
-                categories_hits[cat] = set()
-            categories_hits[cat].add(hit.page_name)
-            # remember page
-            if not pages_hits.has_key(hit.page_name):
-                pages_hits[hit.page_name] = set()
-            pages_hits[hit.page_name].add(cat)
+                tag = match.re_match.group()
+                if not tags.has_key(tag):
+                    tags[tag] = set()
+                tags[tag].add(hit.page_name)
+
+    # the pages of each category are those carrying its tag
+    listed = hits_set
+    if opt_category:
+        # keep the pages of the category, with all their categories
+        tagged = set()
+        for cat, pages in tags.items():
+            if category_rx.match(cat):
+                tagged |= pages
+        listed = listed & tagged
+    if opt_categories:
+        # keep the pages matching the expression, with all their
+        # categories
+        listed = _eval_categories(opt_categories, tags, opt_category_word,
+                                  listed)
+    for cat, pages in tags.items():
+        if not is_name_rx.match(cat): continue
+        pages = pages & listed
+        if not pages: continue
+        # remember category
+        categories_hits[cat] = pages
+        # remember pages
+        for page in pages:
+            if not pages_hits.has_key(page):
+                pages_hits[page] = set()
+            pages_hits[page].add(cat)
 
 
     # format the output
@@ -577,46 +823,36 @@ def _execute(macro, text):
     elif opt_bypages == 0 and opt_cloud:
         keys = sorted(categories_hits.keys())
         if opt_reverse: keys.reverse()
-        min_l = 1000
-        max_l = 0
-        res2 = []
-        for k in keys:
-            v = categories_hits[k]
-            l = len(v)
-            l2 = l
-            if l2 >= len(opt_unit): l2 = len(opt_unit)-1
-            unit = opt_unit[l2]
-            max_l = max(max_l, l)
-            min_l = min(min_l, l)
-            fmt = "[[%(categorypage)s|%(categoryname)s]]"
+        counts = [len(categories_hits[k]) for k in keys]
+        min_l = min(counts + [1000])
+        max_l = max(counts + [0])
+        span = float(max_l - min_l)
 
-            pl = [ "[[%s|%s]]" % (p, split_title(p)) for p in v ]
-            pl = ', '.join(pl)
-            category_name = split_title(k[cat_offset:])
-            w = fmt % {
-                "categorypage": k,
-                "categoryname": category_name.replace(" ", u"\u00A0"),
-                "pages"       : l,
-                "pagelist"    : pl,
-                "unit"        : unit,
-                }
-            res2.append((
-                _format(w, macro.request),
-                l,
-                "%s: %d %s" % (category_name, l, unit)
-                ))
+        # the links are made by the formatter, not by the wiki parser
+        f = macro.formatter
         html = ""
-        span = float(max_l - min_l)
-        if opt_header and len(res2):
+        if opt_header and len(keys):
             html += _format(opt_header, macro.request) + "<BR/>"
-        if opt_empty_header and not len(res2):
+        if opt_empty_header and not len(keys):
             html += _format(opt_empty_header, macro.request) + "<BR/>"
-        for w, l, title in res2:
-            # TODO: in w, remove the enclosing <p>
-            l = float(opt_cloud) * ( 0.75 + (l - min_l) / (span/1.25) )
+        for k, l in zip(keys, counts):
+            l2 = l
+            if l2 >= len(opt_unit): l2 = len(opt_unit)-1
+            unit = opt_unit[l2]
+            category_name = split_title(k[cat_offset:])
+            title = "%s: %d %s" % (category_name, l, unit)
+            link = f.pagelink(1, k) + \
+                   f.text(category_name.replace(" ", u"\u00A0")) + \
+                   f.pagelink(0, k)
+            # from 0.75 to 2 times Cloud, with all the same size if
+            # all the categories have as many pages
+            size = 0.75
+            if span:
+                size += (l - min_l) / (span/1.25)
+            size = float(opt_cloud) * size
             html += """
             <span style="font-size: %fem" title="%s"> %s </span> &nbsp;
-            """ % (l, title, w)
+            """ % (size, wikiutil.escape(title, 1), link)
         return html
         
     elif opt_bypages:
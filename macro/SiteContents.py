@@ -37,6 +37,12 @@ General keywords:
   Format              = 'FMT'        Formatting string to produce wiki text to
                                      display the final result. Use %s to insert
                                      the result.
+                                     As long as this and the other formats
+                                     (links, lists, summaries) keep their
+                                     default, and no summary or page
+                                     contents are displayed, the HTML is
+                                     generated directly, without going
+                                     through wiki text.
                                      Default: '%s'
 
   LinkFormat          = 'FMT'        Format of links to pages.
@@ -116,6 +122,78 @@ General keywords:
                                      %(HEADINGS)d
                                      Default: None
 
+  Cache               = 0, 1         If 1, keep the generated HTML in the
+                                     wiki cache, and reuse it until the
+                                     edit-log moves, i.e. until a page is
+                                     created, changed, renamed or deleted.
+                                     Meant for navigation menus embedded
+                                     in the theme. With Collapse, one
+                                     output is cached per expanded
+                                     branch, the current page being
+                                     highlighted afterwards. Pages
+                                     displayed as 'p' are also rendered
+                                     on their own, and the HTML of each
+                                     page is cached along with it until
+                                     it or its attachments change. The
+                                     list of the pages matching Pages is
+                                     cached the same way; with the
+                                     SiteContentsTree event handler, it
+                                     is updated for the changed pages
+                                     only. These caches are files shared
+                                     by all processes.
+                                     Default: 0 (i.e. no cache)
+
+  Stream              = 0, 1         If 1, when pages are displayed as
+                                     'p', render each page on its own and
+                                     send it right away, instead of
+                                     rendering all pages at once at the
+                                     end. With Cache, only the HTML of
+                                     the pages is cached. The parts of
+                                     Format before and after %s are
+                                     rendered apart from the pages, so
+                                     a Format that wraps the result in
+                                     a block (a table, a div...) does
+                                     not enclose them.
+                                     Default: 0
+
+  ContainsIndex       = 0, 1         If 1, contains() only searches the
+                                     pages that a trigram index of the
+                                     page names and bodies cannot rule
+                                     out. The index is kept in the wiki
+                                     cache, and updated from the
+                                     edit-log. Ignored with Xapian.
+                                     Default: 0
+
+  Prefetch            = NUMBER       If not 0, the pages not yet in the
+                                     headings index are read ahead by
+                                     NUMBER threads while the headings
+                                     are collected. Helps when the data
+                                     dir is on a network file system.
+                                     The output is not changed. NUMBER
+                                     is capped by the wiki config
+                                     setting sitecontents_max_threads
+                                     (default 4); 0 or less disables it.
+                                     Default: 0 (i.e. read one by one)
+
+  Processes           = NUMBER       If not 0, and at least 5000 pages
+                                     are examined, the Pages expression
+                                     is evaluated, and the pages not yet
+                                     in the headings index are read, by
+                                     NUMBER forked processes, each
+                                     handling a share of the pages. Not
+                                     used for expressions calling
+                                     contains(), nor where fork() is
+                                     not available, nor while the
+                                     server process runs more than one
+                                     thread (forking a threaded process
+                                     may deadlock): only use it under a
+                                     prefork, single-threaded server.
+                                     The output is not changed. NUMBER
+                                     is capped by the wiki config
+                                     setting sitecontents_max_processes
+                                     (default 2); 0 or less disables it.
+                                     Default: 0 (i.e. in this process)
+
 Path-related keywords:
 
   PageMaxDepth        = NUMBER       The maximum level of subpages.
@@ -209,6 +287,22 @@ Pages-related keywords:
   PagesReverse        = 0, 1         If 1, reverses the pages sort order.
                                      Default: 0 (i.e. ascending order)
 
+  Limit               = NUMBER       The maximum number of pages listed.
+                                     If more pages match, a "more" link
+                                     to the next ones is appended. When
+                                     the pages are sorted by name, the
+                                     pages are only examined until
+                                     enough are found.
+                                     Default: 0 (i.e. no limit)
+
+  Offset              = NUMBER       The number of matching pages skipped
+                                     before listing. With Limit, the
+                                     "more" link sets it through an
+                                     'offset-XXXXXXXX' URL parameter
+                                     named after the macro arguments,
+                                     which takes precedence.
+                                     Default: 0
+
 Summaries-related keywords:
 
   Summary             = 'NAME'       Use predefined REGEX named NAME for both
@@ -258,6 +352,16 @@ Summaries-related keywords:
                                      text found by HeadingSummaryRx.
                                      Default: '%s'
 
+  SummaryScanLimit    = NUMBER, 'section'
+                                     Where the summaries are searched:
+                                     if NUMBER, only in the first NUMBER
+                                     K characters of the page, or of the
+                                     section for a heading summary; if
+                                     'section', only in the text before
+                                     the next heading (for the page
+                                     summary: after the first line).
+                                     Default: 0 (i.e. the whole text)
+
 Keywords can be also given in upper or lower cases, or abbreviated.
 Example: EnableHeadings, ENABLEHEADINGS, enableheadings, eh, EH, etc.
 
@@ -307,10 +411,17 @@ Pascal Bauermeister <pascal DOT bauermeister AT gmail DOT com> 2007-09-14:
 """
 
 # Imports
-import re, sys, StringIO, urllib, sha, math
+import re, os, sys, errno, mmap, StringIO, urllib, sha, math, bisect, ast
+import zlib
+import threading
+import multiprocessing
+import sre_parse, sre_constants
 from string import ascii_lowercase, maketrans
-from MoinMoin import config, wikiutil, version, search
+from MoinMoin import config, wikiutil, version, search, caching
 from MoinMoin.Page import Page
+from MoinMoin.logfile import editlog
+from MoinMoin.search.queryparser import AndExpression, OrExpression, \
+     TextSearch, TitleSearch
     
 Dependencies = ["pages"]
 NAME = __name__.split(".")[-1]
@@ -353,17 +464,6 @@ def execute(macro, text, args_re=None):
         Error: macro %s: %s</strong> </p>
         """ % (NAME, msg)
 
-def _array2str(a):
-    def join_it(x):
-        if x.__class__ == unicode or x.__class__ == str:
-            return "".join(x)
-        else:
-            return " ".join(x)
-
-    res = map(join_it, a)
-    return res
-
-
 def _delparam(keyword, params):
     value = params[keyword]
     del params[keyword]
@@ -426,8 +526,1477 @@ def _re_compile(text, name):
         raise _Error("%s for regex argument %s: '%s'" % (msg, name, text))
 
 
+def _edit_log_stamp(request):
+    """Returns the (size, mtime) of the global edit-log, or None if there
+    is no edit-log yet"""
+    try:
+        st = os.stat(request.rootpage.getPagePath('edit-log', isfile=1))
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+
+# process-wide snapshot of the names of the existing pages, keyed by
+# data dir: (edit-log stamp, names)
+_page_lists = {}
+
+def _get_page_names(request):
+    """Returns the names of all the existing pages, without checking
+    the read rights. The list is kept process-wide, and listed again
+    only when the edit-log changed; it is also shared with the other
+    processes through the wiki cache dir"""
+    key = request.cfg.data_dir
+    stamp = _edit_log_stamp(request)
+    snapshot = _page_lists.get(key)
+    if snapshot is None or snapshot[0] != stamp:
+        cache = caching.CacheEntry(request, 'sitecontents', 'pagelist',
+                                   scope='wiki', use_pickle=True)
+        names = _cache_get(cache, stamp)
+        if names is None:
+            # sorted once here, so that sorting the pages a user may
+            # read, as _PageIndex does, only takes one pass
+            names = sorted(request.rootpage.getPageList(user='', exists=1))
+            _cache_put(cache, stamp, names)
+        snapshot = (stamp, names)
+        _page_lists[key] = snapshot
+    return snapshot[1]
+
+
+# process-wide read rights, keyed by data dir: the ACL of each page, and
+# the decisions per (ACL, user), both kept up to date from the edit-log
+_read_rights = {}
+
 def _get_all_pages(request):
-    return request.rootpage.getPageList()
+    """Returns the names of the existing pages the user may read. Pages
+    are grouped by ACL, and the read right is checked once per ACL and
+    user; the decisions are kept process-wide until a page ACL or a
+    group page changes. Hierarchic ACLs and custom security policies
+    are checked page by page"""
+    names = _get_page_names(request)
+    cfg = request.cfg
+    user = request.user
+    may_read = user.may.read
+    if cfg.acl_hierarchic or cfg.SecurityPolicy:
+        return [name for name in names if may_read(name)]
+
+    key = cfg.data_dir
+    log = editlog.EditLog(request)
+    rights = _read_rights.get(key)
+    if rights is None or rights['position'] > log.size():
+        rights = {'position': log.size(), 'acls': {}, 'decisions': {}}
+        _read_rights[key] = rights
+    else:
+        position, changed = log.news(rights['position'])
+        if changed:
+            group_rx = re.compile(cfg.page_group_regex, re.UNICODE)
+            for name in changed:
+                rights['acls'].pop(name, None)
+                if group_rx.search(name):
+                    rights['decisions'] = {}
+        rights['position'] = position
+
+    acls = rights['acls']
+    decisions = rights['decisions']
+    user_key = (user.name, user.valid,
+                user.auth_method in cfg.auth_methods_trusted)
+    pages = []
+    for name in names:
+        if acls.has_key(name):
+            acl = acls[name]
+        else:
+            acl = Page(request, name).getACL(request).acl_lines
+            if acl is not None:
+                acl = tuple(acl)
+            acls[name] = acl
+        decision = decisions.get((acl, user_key))
+        if decision is None:
+            # any page with that ACL tells for all of them
+            decision = decisions[(acl, user_key)] = may_read(name)
+        if decision:
+            pages.append(name)
+    return pages
+
+
+# flags of the page classification table
+PAGE_SYSTEM  = 1 # system page
+PAGE_SPECIAL = 2 # category, dict, group or template page (not a subpage)
+
+SPECIAL_PAGE_REGEXES = ('page_category_regex', 'page_dict_regex',
+                        'page_group_regex', 'page_template_regex')
+
+def _special_page_rxs(cfg):
+    """Returns the regexes matching the special pages, as name_matches()
+    would do for each cfg regex: if possible, a single regex combining
+    them, their named groups being made anonymous"""
+    texts = [getattr(cfg, name).replace("_", " ")
+             for name in SPECIAL_PAGE_REGEXES]
+    flags = re.IGNORECASE|re.MULTILINE|re.DOTALL
+    try:
+        return [re.compile("|".join(
+            ["(?:%s)" % re.sub(r"\(\?P<\w+>", "(?:", text)
+             for text in texts]), flags)]
+    except re.error:
+        return [re.compile(text, flags) for text in texts]
+
+
+def _classify_page(request, special_rxs, name):
+    """Returns the PAGE_* flags of a page"""
+    flags = 0
+    if wikiutil.isSystemPage(request, name):
+        flags |= PAGE_SYSTEM
+    if not "/" in name:
+        for rx in special_rxs:
+            if rx.search(name):
+                flags |= PAGE_SPECIAL
+                break
+    return flags
+
+
+# process-wide classification of the pages, keyed by data dir:
+# (page list snapshot, {name: flags})
+_page_classes = {}
+
+def _get_page_classes(request):
+    """Returns a dict giving the PAGE_* flags of each existing page,
+    computed once per page list snapshot"""
+    names = _get_page_names(request)
+    key = request.cfg.data_dir
+    cached = _page_classes.get(key)
+    if cached is not None and cached[0] is names:
+        return cached[1]
+
+    special_rxs = _special_page_rxs(request.cfg)
+    classes = {}
+    for name in names:
+        classes[name] = _classify_page(request, special_rxs, name)
+    _page_classes[key] = (names, classes)
+    return classes
+
+
+class _PageIndex(object):
+
+    """Sorted list of page names. Since all the sub-pages of a page
+    sort right after 'PAGE/', child and descendant questions are
+    answered by a binary search instead of a scan of all pages. The
+    list is only sorted when first needed"""
+
+    def __init__(self, pages):
+        self._pages = pages
+        self._sorted = False
+
+    def _get_pages(self):
+        if not self._sorted:
+            self._pages = sorted(self._pages)
+            self._sorted = True
+        return self._pages
+
+    pages = property(_get_pages)
+
+    def _range(self, page):
+        # '0' is the character following '/': [lo, hi) holds 'PAGE/...'
+        lo = bisect.bisect_left(self.pages, page + "/")
+        hi = bisect.bisect_left(self.pages, page + "0", lo)
+        return lo, hi
+
+    def has_children(self, page):
+        lo, hi = self._range(page)
+        return lo < hi
+
+    def prefixed(self, prefix):
+        """Returns the pages whose name starts with PREFIX"""
+        lo = bisect.bisect_left(self.pages, prefix)
+        hi = bisect.bisect_left(self.pages, prefix + u"\uffff", lo)
+        return self.pages[lo:hi]
+
+
+def _plan_pages(expr, index, this_page, current_page, page_flags):
+
+    """Returns the set of the pages that may match the Pages expression
+    EXPR, as told by its cheap predicates: the name predicates, found
+    by a binary search in INDEX, then 'regular' and 'system', checked
+    with PAGE_FLAGS on the pages left. Returns None if any page may
+    match. The expression still has to be evaluated on the pages"""
+
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+    except (SyntaxError, TypeError, ValueError):
+        return None
+
+    def literal(node):
+        if isinstance(node, ast.Str):
+            if isinstance(node.s, unicode):
+                return node.s
+            try:
+                return node.s.decode('ascii')
+            except UnicodeError:
+                pass
+        return None
+
+    def is_name_predicate(node):
+        return isinstance(node, ast.Call) or \
+               (isinstance(node, ast.Name) and
+                node.id in ('children', 'this', 'this_page'))
+
+    def candidates(node, within):
+        if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+            # the name predicates first, as they give the smallest sets
+            result = within
+            for value in sorted(node.values,
+                                key=lambda value: not is_name_predicate(value)):
+                result = candidates(value, result)
+            return result
+        if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.Or):
+            result = set()
+            for value in node.values:
+                pages = candidates(value, within)
+                if pages is None:
+                    return within
+                result |= pages
+            return result
+
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or len(node.args) != 1 or \
+               node.keywords or node.starargs or node.kwargs:
+                return within
+            what = literal(node.args[0])
+            if what is None:
+                return within
+            what = what.replace("_", " ")
+            if node.func.id == 'name_startswith':
+                pages = index.prefixed(what)
+            elif node.func.id == 'name_is':
+                pages = [page for page in index.prefixed(what) if page == what]
+            else:
+                return within
+        elif isinstance(node, ast.Name) and node.id == 'children':
+            pages = index.prefixed((this_page + "/").replace("_", " "))
+        elif isinstance(node, ast.Name) and node.id in ('this', 'this_page'):
+            if node.id == 'this':
+                name = current_page.replace("_", " ")
+            else:
+                name = this_page
+            pages = [page for page in index.prefixed(name) if page == name]
+        elif isinstance(node, ast.Name) and node.id in ('regular', 'system'):
+            if within is None:
+                within = index.pages
+            if node.id == 'regular':
+                mask, wanted = PAGE_SYSTEM|PAGE_SPECIAL, 0
+            else:
+                mask, wanted = PAGE_SYSTEM, PAGE_SYSTEM
+            return set([page for page in within
+                        if page_flags(page) & mask == wanted])
+        else:
+            return within
+
+        pages = set(pages)
+        if within is not None:
+            pages &= within
+        return pages
+
+    return candidates(tree.body, None)
+
+
+SECTION_START_RX = re.compile("^=", re.M)
+
+
+class _SummaryRx(object):
+
+    """A summary regex, only searched in the first LIMIT kilo-characters
+    of the text, or in its first section if LIMIT is 'section'. The
+    limit is part of the pattern, which keys the summaries in the
+    headings index"""
+
+    def __init__(self, rx, limit=0):
+        self.rx = rx
+        self.limit = limit
+        self.pattern = rx.pattern
+        if limit:
+            self.pattern = u"%s\0%s" % (rx.pattern, limit)
+
+    def first(self, text, pos=0, endpos=None):
+
+        """Returns what re.findall() would first return in
+        TEXT[POS:ENDPOS], or None, without searching further than
+        the first match"""
+
+        if endpos is None:
+            endpos = len(text)
+        if self.limit == 'section':
+            match = SECTION_START_RX.search(text, pos + 1, endpos)
+            if match:
+                endpos = match.start()
+        elif self.limit:
+            endpos = min(endpos, pos + 1024 * self.limit)
+
+        match = self.rx.search(text, pos, endpos)
+        if match is None:
+            return None
+        if not self.rx.groups:
+            return match.group(0)
+        return " ".join([group or "" for group in match.groups()])
+
+
+def _scan_page(page_name, body, page_summary_rx=None, head_summary_rx=None):
+
+    """Parses a page body, and returns its summary and its headings,
+    as a list of (depth, title, anchor, summary) tuples. The summary
+    regexes are _SummaryRx objects"""
+
+    # get the page summary
+    page_summary = None
+    if page_summary_rx:
+        page_summary = page_summary_rx.first(body)
+
+    # a section starts at each line starting with '=', and ends at the
+    # next one; the summaries are searched in the body in place
+    starts = [match.start() for match in SECTION_START_RX.finditer(body)]
+    starts.append(len(body) + 1)
+
+    heads = []
+    anchors = []
+    for i in range(len(starts) - 1):
+        # split first line (heading) and others
+        start, end = starts[i], starts[i+1] - 1
+        eol = body.find("\n", start, end)
+        if eol < 0:
+            eol = pos = end
+        else:
+            pos = eol + 1
+        first_line = body[start:eol]
+        if not first_line.endswith('='): continue
+        while pos < end and body[pos] == "\n": pos += 1
+        while end > pos and body[end-1] == "\n": end -= 1
+        depth, head_title, anchor = _heading(page_name, first_line, anchors)
+        # get the heading summary
+        head_summary = None
+        if head_summary_rx:
+            head_summary = head_summary_rx.first(body, pos, end)
+        # remember heading
+        heads.append((depth, head_title, anchor, head_summary))
+
+    return page_summary, heads
+
+
+def _heading(page_name, first_line, anchors):
+
+    """Returns the depth, title and anchor of a heading line. ANCHORS
+    lists the anchors of the previous headings of the page, and gets
+    this one"""
+
+    # parse first line to get title and depth (number of '=')
+    gd = HEAD_RX.search(first_line).groupdict()
+    eqs = gd.get('eq', '=')
+    head_title = gd.get('title', '<invalid>').strip()
+    depth = len(eqs)
+    # generate anchor
+    s = page_name + head_title
+    s = s. encode(config.charset)
+    anchor = "#head-" + sha.new(s).hexdigest()
+    # store anchor to count similar ones
+    anchors.append(anchor)
+    n = anchors.count(anchor)
+    # add index if needed
+    if n>1:
+        anchor = anchor + "-%d" % n
+    return depth, head_title, anchor
+
+
+# the same as SECTION_START_RX, on the bytes of a revision file
+SECTION_START_BYTES_RX = re.compile("^\r*=", re.M)
+
+
+def _decode(data, start, end, limit=0):
+
+    """Decodes DATA[START:END] the way Page does; with a numeric LIMIT,
+    no more bytes than needed for LIMIT K characters are decoded"""
+
+    if limit and limit != 'section':
+        # utf-8 takes up to 4 bytes a character: cut at a character
+        # boundary past them
+        cut = start + 4 * 1024 * limit
+        if cut < end:
+            while cut > start and 0x80 <= ord(data[cut]) < 0xc0:
+                cut -= 1
+            end = cut
+    return data[start:end].decode(config.charset).replace(u'\r', u'')
+
+
+def _scan_page_file(page_name, filename, page_summary_rx=None,
+                    head_summary_rx=None):
+
+    """Same as _scan_page(), for the revision file FILENAME of the page.
+    The file is memory-mapped, and the headings are found in its bytes:
+    only the heading lines and the text searched for summaries are
+    decoded, so the memory used does not grow with the page size (but
+    with a page summary searched in the whole page)"""
+
+    try:
+        f = open(filename, 'rb')
+    except IOError, err:
+        if err.errno in (errno.ENOENT, errno.ENAMETOOLONG):
+            # no page file: an empty page, as for Page
+            return _scan_page(page_name, u"", page_summary_rx,
+                              head_summary_rx)
+        raise
+    try:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # empty file, or a file system not supporting mmap
+            body = f.read().decode(config.charset).replace(u'\r', u'')
+            return _scan_page(page_name, body, page_summary_rx,
+                              head_summary_rx)
+    finally:
+        f.close()
+
+    try:
+        # get the page summary
+        page_summary = None
+        if page_summary_rx:
+            end = len(data)
+            if page_summary_rx.limit == 'section':
+                match = SECTION_START_BYTES_RX.search(data, 1)
+                if match:
+                    end = match.start()
+            text = _decode(data, 0, end, page_summary_rx.limit)
+            page_summary = page_summary_rx.first(text)
+            del text
+
+        starts = [found.start()
+                  for found in SECTION_START_BYTES_RX.finditer(data)]
+        starts.append(len(data) + 1)
+
+        heads = []
+        anchors = []
+        for i in range(len(starts) - 1):
+            # split first line (heading) and others
+            start, end = starts[i], starts[i+1] - 1
+            eol = data.find("\n", start, end)
+            if eol < 0:
+                eol = pos = end
+            else:
+                pos = eol + 1
+            first_line = _decode(data, start, eol)
+            if not first_line.endswith('='): continue
+            depth, head_title, anchor = _heading(page_name, first_line,
+                                                 anchors)
+            # get the heading summary
+            head_summary = None
+            if head_summary_rx:
+                while pos < end and data[pos] in "\r\n": pos += 1
+                while end > pos and data[end-1] in "\r\n": end -= 1
+                text = _decode(data, pos, end, head_summary_rx.limit)
+                head_summary = head_summary_rx.first(text)
+            # remember heading
+            heads.append((depth, head_title, anchor, head_summary))
+    finally:
+        data.close()
+
+    return page_summary, heads
+
+
+# below this number of pages, Processes is ignored: starting the
+# processes would cost more than it saves
+PARALLEL_MIN_PAGES = 5000
+
+_parallel_lock = threading.Lock()
+_parallel_work = None
+
+
+def _parallel(processes, count):
+
+    """Tells whether COUNT items are worth PROCESSES processes"""
+
+    # a forked child only gets the calling thread: a lock held by
+    # another thread at fork time would never be released in it
+    return (processes and count >= PARALLEL_MIN_PAGES
+            and hasattr(os, 'fork') and threading.activeCount() == 1)
+
+
+def _parallel_run(items):
+    return _parallel_work(items)
+
+
+def _parallel_map(work, items, processes):
+
+    """Calls WORK on slices of the ITEMS list in PROCESSES processes, and
+    returns the lists it returned, concatenated in the order of ITEMS.
+    The processes are forked, so WORK and what it uses (the request,
+    the closures of the macro...) need not be pickled, unlike ITEMS
+    and the results"""
+
+    global _parallel_work
+    size = max(1, -(-len(items) // (4 * processes)))
+    slices = [items[i:i+size] for i in range(0, len(items), size)]
+
+    # the work is inherited when the pool forks its processes
+    _parallel_lock.acquire()
+    try:
+        _parallel_work = work
+        try:
+            pool = multiprocessing.Pool(processes)
+        finally:
+            _parallel_work = None
+    finally:
+        _parallel_lock.release()
+
+    try:
+        results = pool.map(_parallel_run, slices)
+        pool.close()
+    finally:
+        pool.terminate()
+    merged = []
+    for result in results:
+        merged.extend(result)
+    return merged
+
+
+def _stale_entry(entry, revfile, page_key, head_key):
+
+    """Tells whether an entry of the heading index must be built again
+    from the page body"""
+
+    return entry is None or entry['rev'] != revfile or \
+           entry['heads'] is None or \
+           (page_key and not entry['page_summaries'].has_key(page_key)) or \
+           (head_key and not entry['head_summaries'].has_key(head_key))
+
+
+class _Prefetcher(object):
+
+    """Reads the revision of pages, and their body when the heading
+    index cannot answer, in a few threads ahead of the lookups. The
+    pages must be asked for in the order they were given; at most
+    AHEAD pages are read but not asked for yet, which bounds the
+    memory used for the bodies. ENTRY gives the index entry of a page"""
+
+    def __init__(self, request, page_names, entry, page_key, head_key,
+                 threads, ahead):
+        self.request = request
+        self.page_names = page_names
+        self.entry = entry
+        self.page_key = page_key
+        self.head_key = head_key
+        self.ahead = ahead
+        self.cond = threading.Condition()
+        self.next = 0      # index of the next page to read
+        self.asked = 0     # number of pages asked for
+        self.results = {}  # page name -> (revfile, body or None)
+        self.stopped = False
+        for i in range(threads):
+            thread = threading.Thread(target=self._run)
+            thread.setDaemon(True)
+            thread.start()
+
+    def _run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.stopped and \
+                      self.next < len(self.page_names) and \
+                      self.next >= self.asked + self.ahead:
+                    self.cond.wait()
+                if self.stopped or self.next >= len(self.page_names):
+                    return
+                page_name = self.page_names[self.next]
+                self.next += 1
+            finally:
+                self.cond.release()
+
+            try:
+                page = Page(self.request, page_name)
+                revfile = page.get_rev()[0]
+                body = None
+                if _stale_entry(self.entry(page_name), revfile,
+                                self.page_key, self.head_key):
+                    body = page.get_raw_body()
+            except Exception:
+                # the lookup will read the page itself, and report
+                revfile = body = None
+
+            self.cond.acquire()
+            try:
+                self.results[page_name] = (revfile, body)
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+
+    def get(self, page_name):
+
+        """Returns (revfile, body) of the next page, either being None
+        if it could not be read"""
+
+        self.cond.acquire()
+        try:
+            if self.asked >= len(self.page_names) or \
+               self.page_names[self.asked] != page_name:
+                return None, None
+            self.asked += 1
+            self.cond.notifyAll()
+            while not self.results.has_key(page_name):
+                self.cond.wait()
+            return self.results.pop(page_name)
+        finally:
+            self.cond.release()
+
+    def stop(self):
+        self.cond.acquire()
+        try:
+            self.stopped = True
+            self.results = {}
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+
+class _PersistentIndex(object):
+
+    """Base of the persistent indexes of the pages, stored in the wiki
+    cache dir. Each family of entries is split in BUCKETS files by a
+    hash of the entry key, so that a change only rewrites the buckets
+    it touched. The files are read when first needed, and kept
+    process-wide while they do not change, unless their family is
+    TRANSIENT: they may be shared, and are copied before a change"""
+
+    BUCKETS = 16
+    TRANSIENT = ()
+
+    # process-wide copy of the files last read or written, keyed by
+    # (arena dir, cache key): (uid, content)
+    _loaded = {}
+
+    def __init__(self, request, arena, name):
+        self.request = request
+        self.arena = arena
+        self.name = name
+        self.arena_dir = caching.get_arena_dir(request, arena, 'wiki')
+        self.shards = {}   # (family, bucket) -> {key: entry}
+        self.dirty = set() # (family, bucket) copied, to be written
+
+    def _cache(self, key):
+        return caching.CacheEntry(self.request, self.arena, key,
+                                  scope='wiki', use_pickle=True)
+
+    def _read(self, key, default, keep=True):
+        """Returns the content of the file KEY, or DEFAULT"""
+        cache = self._cache(key)
+        uid = cache.uid()
+        loaded = self._loaded.get((self.arena_dir, key))
+        if loaded and loaded[0] == uid:
+            return loaded[1]
+        try:
+            content = cache.content()
+        except caching.CacheError:
+            content = default
+        if keep:
+            self._loaded[(self.arena_dir, key)] = (uid, content)
+        return content
+
+    def _write(self, key, content, keep=True):
+        cache = self._cache(key)
+        try:
+            cache.update(content)
+        except caching.CacheError:
+            return
+        if keep:
+            self._loaded[(self.arena_dir, key)] = (cache.uid(), content)
+
+    def _head(self):
+        """Returns what was stored by _set_head(), or None"""
+        return self._read(self.name + '-head', None)
+
+    def _set_head(self, head):
+        self._write(self.name + '-head', head)
+
+    def _bucket(self, key):
+        return (zlib.crc32(key.encode(config.charset)) & 0xffffffff) % \
+               self.BUCKETS
+
+    def _shard(self, family, bucket):
+        shard = self.shards.get((family, bucket))
+        if shard is None:
+            shard = self._read('%s-%s-%02d' % (self.name, family, bucket),
+                               {}, not family in self.TRANSIENT)
+            # the prefetch threads may load buckets too: keep the first
+            shard = self.shards.setdefault((family, bucket), shard)
+        return shard
+
+    def _writable(self, family, key):
+        """Returns the bucket of KEY in FAMILY, ready to be changed"""
+        bucket = self._bucket(key)
+        shard = self._shard(family, bucket)
+        if not (family, bucket) in self.dirty:
+            # copy on write: the loaded bucket may be shared
+            shard = self.shards[(family, bucket)] = shard.copy()
+            self.dirty.add((family, bucket))
+        return shard
+
+    def get(self, family, key):
+        return self._shard(family, self._bucket(key)).get(key)
+
+    def put(self, family, key, entry):
+        """Sets the ENTRY of KEY in FAMILY, or removes it if None"""
+        shard = self._writable(family, key)
+        if entry is None:
+            shard.pop(key, None)
+        else:
+            shard[key] = entry
+
+    def entries(self, family):
+        """Returns a dict of all the entries of FAMILY"""
+        entries = {}
+        for bucket in range(self.BUCKETS):
+            entries.update(self._shard(family, bucket))
+        return entries
+
+    def fill(self, family, entries):
+        """Replaces all the entries of FAMILY by the ENTRIES dict"""
+        shards = [{} for bucket in range(self.BUCKETS)]
+        for key, entry in entries.iteritems():
+            shards[self._bucket(key)][key] = entry
+        for bucket in range(self.BUCKETS):
+            self.shards[(family, bucket)] = shards[bucket]
+            self.dirty.add((family, bucket))
+
+    def save(self):
+        """Writes the buckets changed"""
+        for family, bucket in sorted(self.dirty):
+            self._write('%s-%s-%02d' % (self.name, family, bucket),
+                        self.shards[(family, bucket)],
+                        not family in self.TRANSIENT)
+        self.dirty = set()
+
+
+class _HeadingIndex(_PersistentIndex):
+
+    """Persistent index of the page headings and summaries, stored in
+    the wiki cache dir. Entries are keyed by page name, and are only
+    valid for the revision they were built from: a page is re-read
+    only when its revision changed, or when a summary regex not seen
+    yet is asked for. The entries of the pages deleted or renamed are
+    dropped as the edit-log tells"""
+
+    def __init__(self, request):
+        _PersistentIndex.__init__(self, request, 'sitecontents', 'headings')
+        self.prefetcher = None
+
+    def entry(self, page_name):
+        return self.get('entries', page_name)
+
+    def prefetch(self, page_names, page_summary_rx=None,
+                 head_summary_rx=None, threads=4):
+
+        """Reads the pages about to be looked up, in that order, in
+        THREADS threads: worth it when reading a file mostly means
+        waiting for the storage, e.g. on a network file system"""
+
+        page_key = page_summary_rx and page_summary_rx.pattern
+        head_key = head_summary_rx and head_summary_rx.pattern
+        self.prefetcher = _Prefetcher(self.request, list(page_names),
+                                      self.entry, page_key, head_key,
+                                      threads, 4 * threads)
+
+    def lookup(self, page_name, page_summary_rx=None, head_summary_rx=None):
+
+        """Returns (summary, headings) of a page, headings being a list
+        of (depth, title, anchor, summary) tuples. The body of the page
+        is read only if the index cannot answer"""
+
+        revfile = body = None
+        if self.prefetcher is not None:
+            revfile, body = self.prefetcher.get(page_name)
+        if revfile is None:
+            revfile = Page(self.request, page_name).get_rev()[0]
+        entry = self.entry(page_name)
+        if entry is None or entry['rev'] != revfile:
+            entry = {'rev': revfile, 'heads': None,
+                     'page_summaries': {}, 'head_summaries': {}}
+        page_key = page_summary_rx and page_summary_rx.pattern
+        head_key = head_summary_rx and head_summary_rx.pattern
+
+        if _stale_entry(entry, revfile, page_key, head_key):
+            entry = self._build(page_name, revfile, body, entry,
+                                page_summary_rx, head_summary_rx)
+            self._store([(page_name, entry)])
+
+        page_summary = None
+        if page_key:
+            page_summary = entry['page_summaries'][page_key]
+        if head_key:
+            head_summaries = entry['head_summaries'][head_key]
+        else:
+            head_summaries = [None] * len(entry['heads'])
+        heads = [head + (summary,)
+                 for head, summary in zip(entry['heads'], head_summaries)]
+        return page_summary, heads
+
+    def _build(self, page_name, revfile, body, entry,
+               page_summary_rx, head_summary_rx):
+
+        """Returns ENTRY completed from the page BODY, or from the
+        revision file if BODY is None"""
+
+        if body is None:
+            page_summary, heads = _scan_page_file(page_name, revfile,
+                                                  page_summary_rx,
+                                                  head_summary_rx)
+        else:
+            page_summary, heads = _scan_page(page_name, body,
+                                             page_summary_rx,
+                                             head_summary_rx)
+        entry = {
+            'rev': revfile,
+            'heads': [head[:3] for head in heads],
+            'page_summaries': entry['page_summaries'].copy(),
+            'head_summaries': entry['head_summaries'].copy(),
+            }
+        if page_summary_rx:
+            entry['page_summaries'][page_summary_rx.pattern] = page_summary
+        if head_summary_rx:
+            entry['head_summaries'][head_summary_rx.pattern] = \
+                [head[3] for head in heads]
+        return entry
+
+    def _store(self, entries):
+        for page_name, entry in entries:
+            self.put('entries', page_name, entry)
+
+    def update(self, page_names, page_summary_rx=None, head_summary_rx=None,
+               processes=2):
+
+        """Builds the entries the lookups of PAGE_NAMES would build, in
+        PROCESSES processes"""
+
+        page_key = page_summary_rx and page_summary_rx.pattern
+        head_key = head_summary_rx and head_summary_rx.pattern
+
+        def build(page_names):
+            built = []
+            for page_name in page_names:
+                revfile = Page(self.request, page_name).get_rev()[0]
+                entry = self.entry(page_name)
+                if entry is None or entry['rev'] != revfile:
+                    entry = {'rev': revfile, 'heads': None,
+                             'page_summaries': {}, 'head_summaries': {}}
+                if _stale_entry(entry, revfile, page_key, head_key):
+                    built.append((page_name, self._build(
+                        page_name, revfile, None, entry,
+                        page_summary_rx, head_summary_rx)))
+            return built
+
+        self._store(_parallel_map(build, list(page_names), processes))
+
+    def _prune(self):
+
+        """Drops the entries of the pages that no longer exist: those
+        the edit-log tells about since the last time, or all of them if
+        the edit-log was cut since"""
+
+        log = editlog.EditLog(self.request)
+        head = self._head()
+        if head is None:
+            position, page_names = log.size(), ()
+        elif head['position'] > log.size():
+            existing = set(_get_page_names(self.request))
+            page_names = [page_name for page_name in self.entries('entries')
+                          if not page_name in existing]
+            position = log.size()
+        else:
+            position, page_names = log.news(head['position'])
+            if position == head['position']:
+                return None
+        for page_name in set(page_names):
+            if self.entry(page_name) is not None and \
+               not Page(self.request, page_name).exists():
+                self.put('entries', page_name, None)
+        return {'position': position}
+
+    def save(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+        head = self._prune()
+        _PersistentIndex.save(self)
+        if head is not None:
+            self._set_head(head)
+
+
+class _HtmlList(object):
+
+    """Opens and closes nested HTML lists through the formatter, the
+    same way the wiki parser does for list items of a given indent"""
+
+    def __init__(self, formatter):
+        self.formatter = formatter
+        self.levels = [] # (indent, numbered) of each open list
+
+    def _close_last(self):
+        indent, numbered = self.levels.pop()
+        f = self.formatter
+        if numbered:
+            return f.listitem(0) + f.number_list(0)
+        return f.listitem(0) + f.bullet_list(0)
+
+    def item(self, indent, numbered, html):
+        f = self.formatter
+        out = []
+        while self.levels and self.levels[-1][0] > indent:
+            out.append(self._close_last())
+        if self.levels and self.levels[-1] == (indent, not numbered):
+            out.append(self._close_last())
+        if self.levels and self.levels[-1][0] == indent:
+            out.append(f.listitem(0))
+        else:
+            if numbered:
+                out.append(f.number_list(1, type="1"))
+            else:
+                out.append(f.bullet_list(1))
+            self.levels.append((indent, numbered))
+        out.append(f.listitem(1))
+        out.append(html)
+        return "".join(out)
+
+    def close(self):
+        out = []
+        while self.levels:
+            out.append(self._close_last())
+        return "".join(out)
+
+
+ATTACHMENT_RXS = (re.compile("\{\{attachment:[^/}]+?}}"),
+                  re.compile("\[\[attachment:[^/}]+?]]"))
+HEADING_LINE_RX = re.compile("^(=.*=) *$", re.M)
+TOC_RX = re.compile("<<TableOfContents.*?>>")
+
+
+def _one_page_text(page_name, body, levels):
+
+    """Returns the wiki text of a page to be concatenated with others:
+    attachments are made relative to the page, headings are shifted
+    by the page depth, and tables of contents and comments are
+    removed"""
+
+    h = "=" * len(levels)
+
+    # adjust attachments
+    def replacer(m):
+        s = m.group(0)
+        return s[:13] + page_name + "/" + s[13:]
+    for rx in ATTACHMENT_RXS:
+        body = rx.sub(replacer, body)
+
+    # adjust headings
+    body = HEADING_LINE_RX.sub(h + r'\1' + h, body)
+
+    # remove TOCs
+    body = TOC_RX.sub("", body)
+
+    # remove comments
+    body = body.split("\n")
+    body = [ l for l in body if not l.startswith("#") ]
+    body = "\n".join(body)
+
+    ttl = split_title(levels[-1], True)
+    return "<<BR>>" * 2 + "\n" + "%s [%s] %s\n" % (h, ttl, h) + body
+
+
+def _edit_log_position(request):
+    """Returns the size of the global edit-log, which grows each time a
+    page is created, changed, renamed or deleted"""
+    return editlog.EditLog(request).size()
+
+
+def _cache_get(cache, stamp):
+    """Returns what is stored in the CacheEntry CACHE, if it was stored
+    along with STAMP, or None"""
+    try:
+        cached_stamp, value = cache.content()
+        if cached_stamp == stamp:
+            return value
+    except (caching.CacheError, TypeError, ValueError):
+        pass
+    return None
+
+
+def _cache_put(cache, stamp, value):
+    """Stores VALUE along with STAMP in the CacheEntry CACHE; the file
+    is replaced atomically, so that other processes read either the
+    old or the new value"""
+    try:
+        cache.update((stamp, value))
+    except caching.CacheError:
+        pass
+
+
+def _cached(cache, stamp, render):
+
+    """Returns what is stored in the CacheEntry CACHE, if it was stored
+    along with STAMP; otherwise calls RENDER to get it, and stores it"""
+
+    html = _cache_get(cache, stamp)
+    if html is None:
+        html = render()
+        _cache_put(cache, stamp, html)
+    return html
+
+
+def _cached_output(request, key, render):
+
+    """Returns the HTML cached under KEY in the wiki cache dir, if the
+    edit-log did not move since it was generated; otherwise calls
+    RENDER to get it, and caches it"""
+
+    cache = caching.CacheEntry(request, 'sitecontents', key,
+                               scope='wiki', use_pickle=True)
+    return _cached(cache, _edit_log_position(request), render)
+
+
+def _cached_page_html(request, page_name, host_page, shift, render):
+
+    """Returns the HTML of PAGE_NAME rendered by RENDER with its
+    headings shifted by SHIFT levels, for the current user and as
+    included in HOST_PAGE, cached along with the page as long as
+    neither its revision nor its attachments changed"""
+
+    page = Page(request, page_name)
+    stamp = [page.get_rev()[0]]
+    try:
+        stamp.append(os.path.getmtime(
+            page.getPagePath('attachments', check_create=0)))
+    except OSError:
+        stamp.append(None)
+    user = request.user.valid and request.user.name or ''
+    key = 'sitecontents-p%d-%s' % (shift, sha.new(
+        repr((user, host_page)).encode(config.charset)).hexdigest())
+    cache = caching.CacheEntry(request, page, key,
+                               scope='item', use_pickle=True)
+    return _cached(cache, tuple(stamp), render)
+
+
+def _required_literals(pattern, flags=0):
+
+    """Returns a list of strings that any match of the regex PATTERN
+    must contain; the list may be empty if nothing is sure"""
+
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return []
+
+    literals = []
+    def walk(items):
+        run = []
+        for op, av in items:
+            if op == sre_constants.LITERAL:
+                run.append(unichr(av))
+                continue
+            if run:
+                literals.append(u"".join(run))
+                run = []
+            if op == sre_constants.SUBPATTERN:
+                walk(av[1])
+            elif op in (sre_constants.MAX_REPEAT,
+                        sre_constants.MIN_REPEAT) and av[0] >= 1:
+                walk(av[2])
+            elif op == sre_constants.BRANCH and len(av[1]) == 1:
+                walk(av[1][0])
+        if run:
+            literals.append(u"".join(run))
+    walk(parsed)
+    return literals
+
+
+def _trigrams(text):
+    text = text.lower()
+    return set([text[i:i+3] for i in xrange(len(text) - 2)])
+
+
+class _InvertedIndex(_PersistentIndex):
+
+    """Persistent index of the terms found in each page, and of the
+    pages holding each term, stored in the wiki cache dir under NAME.
+    It is brought up to date from the edit-log, calling TERMS only for
+    the pages changed since: TERMS(page_name) returns the frozenset of
+    the terms of a page, or None if it does not exist. Only the
+    postings are kept in memory; the terms of a page are read back
+    from its bucket when it changed"""
+
+    TRANSIENT = ('pages',)
+
+    def __init__(self, request, arena, name, terms):
+        _PersistentIndex.__init__(self, request, arena, name)
+        self.terms = terms
+        self._update()
+
+    def _update(self):
+        log = editlog.EditLog(self.request)
+        head = self._head()
+        if head is None or head['position'] > log.size():
+            # (re)build it all; pages changed meanwhile will be read
+            # again next time
+            position = log.size()
+            pages = {}
+            postings = {}
+            for page_name in _get_page_names(self.request):
+                terms = self.terms(page_name)
+                if not terms: continue
+                pages[page_name] = terms
+                for term in terms:
+                    postings.setdefault(term, set()).add(page_name)
+            self.fill('pages', pages)
+            self.fill('postings', postings)
+        else:
+            position, page_names = log.news(head['position'])
+            if position == head['position']:
+                return
+            copied = set()
+            def posting(term):
+                shard = self._writable('postings', term)
+                if not term in copied:
+                    shard[term] = set(shard.get(term, ()))
+                    copied.add(term)
+                return shard[term]
+            for page_name in set(page_names):
+                old = self.get('pages', page_name) or frozenset()
+                new = self.terms(page_name) or frozenset()
+                if new == old: continue
+                for term in old - new:
+                    pages = posting(term)
+                    pages.discard(page_name)
+                    if not pages:
+                        del self._writable('postings', term)[term]
+                        copied.discard(term)
+                for term in new - old:
+                    posting(term).add(page_name)
+                self.put('pages', page_name, new or None)
+
+        self.save()
+        self._set_head({'position': position})
+
+    def pages(self, term):
+        """Returns the set of the pages holding TERM"""
+        return self.get('postings', term) or set()
+
+    def postings(self):
+        """Returns a dict giving the set of the pages holding each term"""
+        return self.entries('postings')
+
+
+class _TrigramIndex(_InvertedIndex):
+
+    """Persistent index of the trigrams found in the name and body of
+    each page, which tells which pages may match a regex search query"""
+
+    def __init__(self, request):
+        _InvertedIndex.__init__(self, request, 'sitecontents', 'trigrams',
+                                self._page_trigrams)
+
+    def _page_trigrams(self, page_name):
+        page = Page(self.request, page_name)
+        if not page.exists():
+            return None
+        return frozenset(_trigrams(page_name) | _trigrams(page.get_raw_body()))
+
+    def candidates(self, query):
+
+        """Returns the set of the names of the pages that may match
+        QUERY, a parsed search query, or None if the index cannot tell
+        (e.g. for negated terms, or regexes without literal text)"""
+
+        if query.negated:
+            return None
+
+        if isinstance(query, OrExpression):
+            result = set()
+            for term in query._subterms:
+                pages = self.candidates(term)
+                if pages is None:
+                    return None
+                result |= pages
+            return result
+
+        if isinstance(query, AndExpression):
+            result = None
+            for term in query._subterms:
+                pages = self.candidates(term)
+                if pages is None: continue
+                if result is None:
+                    result = pages
+                else:
+                    result = result & pages
+            return result
+
+        if isinstance(query, (TextSearch, TitleSearch)):
+            trigrams = set()
+            for literal in _required_literals(query.pattern,
+                                              query.search_re.flags):
+                trigrams |= _trigrams(literal)
+            if not trigrams:
+                return None
+            result = None
+            for trigram in trigrams:
+                pages = self.pages(trigram)
+                if result is None:
+                    result = set(pages)
+                else:
+                    result &= pages
+                if not result: break
+            return result
+
+        return None
+
+
+def contains_hits(request, what, use_index=False):
+
+    """Returns the names of the pages the user may read and whose name
+    or body match WHAT, a regex search query. With USE_INDEX, and
+    unless the wiki uses Xapian, only the pages that the trigram index
+    cannot rule out are searched"""
+
+    parser = search.QueryParser(regex=1)
+    query = parser.parse_query(what)
+    if use_index and not request.cfg.xapian_search:
+        candidates = _TrigramIndex(request).candidates(query)
+        if candidates is not None:
+            if not candidates:
+                return []
+            pages = [{'pagename': page_name, 'attachment': '',
+                      'wikiname': 'Self'}
+                     for page_name in sorted(candidates)]
+            results = search.MoinSearch(request, query, pages=pages).run()
+            return [h.page_name for h in results.hits]
+    results = search.searchPages(request, query)
+    return [h.page_name for h in results.hits]
+
+
+# process-wide bullet lists of the PagesOrder pages, keyed by (data dir,
+# page name): (revision file, terms)
+_order_pages = {}
+
+def _order_page_terms(request, page_name):
+    """Returns the terms of the bullet list of the page PAGE_NAME, read
+    again only when the page revision changed"""
+    key = (request.cfg.data_dir, page_name)
+    revfile = Page(request, page_name).get_rev()[0]
+    cached = _order_pages.get(key)
+    if cached is None or cached[0] != revfile:
+        body = Page(request, page_name).get_raw_body()
+        lines = body.split("\n")
+        lines = [l.strip() for l in lines]
+        lines = [l[1:] for l in lines if l.startswith("*")]
+        lines = [l.strip() for l in lines]
+        cached = (revfile, lines)
+        _order_pages[key] = cached
+    return cached[1]
+
+
+# process-wide compiled PagesOrder matchers, keyed by their terms
+_order_matchers = {}
+
+MAX_ORDER_GROUPS = 99
+
+class _OrderMatcher(object):
+
+    """Ranks page names by the first PagesOrder regex they match. The
+    regexes are combined in alternations, each regex in a group whose
+    index gives its rank, so that one search ranks a page; regexes
+    that cannot be combined safely (not anchored at the start,
+    referring to groups, or changing flags) are searched alone"""
+
+    def __init__(self, order):
+        # ORDER is a list of (regex text, rank)
+        flags = re.IGNORECASE|re.MULTILINE|re.DOTALL
+        self.segments = [] # (rx, {group index: rank} or rank)
+        alternatives = []
+        ranks = {}
+        groups = 0
+        for text, rank in order:
+            rx = _re_compile(text, 'PagesOrder')
+            if not self._combinable(text, flags) or \
+               rx.groups + 1 > MAX_ORDER_GROUPS:
+                if alternatives:
+                    self._add(alternatives, ranks, flags)
+                    alternatives, ranks, groups = [], {}, 0
+                self.segments.append((rx, rank))
+                continue
+            if groups + rx.groups + 1 > MAX_ORDER_GROUPS:
+                self._add(alternatives, ranks, flags)
+                alternatives, ranks, groups = [], {}, 0
+            ranks[groups + 1] = rank
+            alternatives.append("(%s)" % text)
+            groups += rx.groups + 1
+        if alternatives:
+            self._add(alternatives, ranks, flags)
+
+    def _combinable(self, text, flags):
+        try:
+            parsed = sre_parse.parse(text, flags)
+        except Exception:
+            return False
+        if parsed.pattern.flags != flags or not len(parsed) or \
+           parsed[0] != (sre_constants.AT, sre_constants.AT_BEGINNING):
+            return False
+        def refers(av):
+            if isinstance(av, sre_parse.SubPattern):
+                av = av.data
+            if isinstance(av, (list, tuple)):
+                for item in av:
+                    if isinstance(item, tuple) and item and \
+                       item[0] in (sre_constants.GROUPREF,
+                                   sre_constants.GROUPREF_EXISTS):
+                        return True
+                    if refers(item):
+                        return True
+            return False
+        return not refers(parsed)
+
+    def _add(self, alternatives, ranks, flags):
+        if len(alternatives) == 1:
+            self.segments.append((re.compile(alternatives[0], flags),
+                                  ranks.values()[0]))
+        else:
+            self.segments.append((re.compile("|".join(alternatives), flags),
+                                  ranks))
+
+    def rank(self, name):
+        """Returns the rank of the first regex NAME matches, or None"""
+        for rx, ranks in self.segments:
+            m = rx.search(name)
+            if m is not None:
+                if isinstance(ranks, dict):
+                    return ranks[m.lastindex]
+                return ranks
+        return None
+
+
+def _order_matcher(order):
+    key = tuple(order)
+    matcher = _order_matchers.get(key)
+    if matcher is None:
+        if len(_order_matchers) > 100:
+            _order_matchers.clear()
+        matcher = _order_matchers[key] = _OrderMatcher(order)
+    return matcher
+
+
+# number of changes kept in the page tree journal
+TREE_JOURNAL_SIZE = 1000
+
+def _tree_cache(request):
+    return caching.CacheEntry(request, 'sitecontents', 'tree', scope='wiki',
+                              do_locking=False, use_pickle=True)
+
+
+def _load_tree(request):
+    """Returns the page tree journal, or None"""
+    try:
+        return _tree_cache(request).content()
+    except caching.CacheError:
+        return None
+
+
+def tree_changed(request, page_names):
+
+    """Records in the page tree journal that the pages PAGE_NAMES were
+    changed, along with the current edit-log position. Called by the
+    SiteContentsTree event handler, after the edit-log was written"""
+
+    cache = _tree_cache(request)
+    try:
+        cache.lock('w')
+    except caching.CacheError:
+        return
+    try:
+        try:
+            tree = cache.content()
+        except caching.CacheError:
+            tree = {'serial': 0, 'changes': []}
+        serial = tree['serial'] + 1
+        changes = tree['changes'][-TREE_JOURNAL_SIZE+1:]
+        changes.append((serial, list(page_names)))
+        try:
+            cache.update({'serial': serial, 'changes': changes,
+                          'position': _edit_log_position(request)})
+        except caching.CacheError:
+            pass
+    finally:
+        cache.unlock()
+
+
+def _tree_changes(tree, serial):
+    """Returns the set of the names of the pages changed since SERIAL,
+    according to the page tree journal TREE, or None if it cannot tell"""
+    if tree is None or serial is None or serial > tree['serial']:
+        # no journal, or one started again since SERIAL
+        return None
+    changes = tree['changes']
+    if serial != tree['serial'] and \
+       (not changes or changes[0][0] > serial + 1):
+        return None
+    page_names = set()
+    for change_serial, names in changes:
+        if change_serial > serial:
+            page_names.update(names)
+    return page_names
+
+
+def _highlight_link(formatter, parts, link_parts, page_name):
+
+    """Returns the HTML made of PARTS, the part holding the link to
+    PAGE_NAME, as given by LINK_PARTS, being highlighted"""
+
+    ix = link_parts.get(page_name)
+    if ix is not None:
+        parts = parts[:]
+        parts[ix] = formatter.strong(1) + parts[ix] + formatter.strong(0)
+    return "".join(parts)
+
+
+PAGES_FUNCTIONS = ('name_contains', 'name_is', 'name_startswith',
+                   'name_endswith', 'name_matches', 'contains')
+PAGES_VARIABLES = ('regular', 'system', 'this_page', 'others', 'all',
+                   'this', 'children', 'has_child')
+
+
+def _compile_pages(expr):
+
+    """Compiles the Pages expression into a code object, once per macro
+    call. Only the functions and variables documented for Pages may be
+    used: any other name, attribute access included, is refused here
+    rather than when the expression is evaluated"""
+
+    def invalid(reason):
+        return _Error("""invalid expression for Pages argument: %s
+                <br>(reason: %s)
+                """ % (expr, reason))
+
+    try:
+        code = compile(expr.strip(), '<Pages>', 'eval')
+    except (SyntaxError, TypeError, ValueError), msg:
+        raise invalid(msg)
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            raise invalid("lambdas and generators are not allowed")
+    for name in code.co_names:
+        if name not in PAGES_FUNCTIONS and name not in PAGES_VARIABLES:
+            raise invalid("name '%s' is not defined" % name)
+    return code
+
+
+class _PagesLocals(object):
+
+    """Locals mapping for evaluating the compiled Pages expression:
+    functions are returned as is, while variables are callables that
+    are only invoked when the expression looks them up"""
+
+    def __init__(self, functions, variables):
+        self.functions = functions
+        self.variables = variables
+
+    def __getitem__(self, name):
+        if self.functions.has_key(name):
+            return self.functions[name]
+        return self.variables[name]()
 
 
 def get_rx(name):
@@ -443,7 +2012,7 @@ def get_rx(name):
 
 
 # The "raison d'etre" of this module
-def _execute(macro, text):
+def _execute(macro, text, use_cache=True, skeleton=False):
 
     debug_html = ""
     if not text: text = ""
@@ -459,6 +2028,7 @@ def _execute(macro, text):
         <br> usage:
         <pre>%s</pre>
         """ % (text, msg, _usage()))
+    raw_params = params.copy()
 
     DEF_P   = 'name_matches("")'
     DEF_P   = 'regular'
@@ -504,6 +2074,7 @@ def _execute(macro, text):
     arg_page_summary_fmt = _param_get(params, 'PageSummaryFormat'   , DEF_PSF)
     arg_head_summary_rx  = _param_get(params, 'HeadingSummaryRx'    , None)
     arg_head_summary_fmt = _param_get(params, 'HeadingSummaryFormat', DEF_PSF)
+    arg_summary_limit    = _param_get(params, 'SummaryScanLimit'    , 0)
 
     tmp                  = _param_get(params, 'SummaryRx'           , None)
     if tmp: arg_page_summary_rx = arg_head_summary_rx = tmp
@@ -521,9 +2092,18 @@ def _execute(macro, text):
     arg_pages_order_dbg  = _param_get(params, 'PagesOrderDebug'     , 0)
     arg_pages_reverse    = _param_get(params, 'PagesReverse'        , 0)
 
+    arg_limit            = _param_get(params, 'Limit'               , 0)
+    arg_offset           = _param_get(params, 'Offset'              , 0)
+
     arg_format           = _param_get(params, 'Format'              , '%s')
     arg_nolink           = _param_get(params, 'PageListNoLink'      , 0)
 
+    arg_cache            = _param_get(params, 'Cache'               , 0)
+    arg_stream           = _param_get(params, 'Stream'              , 0)
+    arg_contains_index   = _param_get(params, 'ContainsIndex'       , 0)
+    arg_prefetch         = _param_get(params, 'Prefetch'            , 0)
+    arg_processes        = _param_get(params, 'Processes'           , 0)
+
     opt_help             = _param_get(params, 'Help'                , 0)
     opt_debug            = _param_get(params, 'Debug'               , 0)
 
@@ -576,90 +2156,226 @@ def _execute(macro, text):
     this_page = macro.formatter.page.page_name
 
     here_page = macro.request.form.get("here", None)
+
+    if not isinstance(arg_limit, (int, long)):
+        raise _Error("Limit must be a number")
+    if not isinstance(arg_offset, (int, long)):
+        raise _Error("Offset must be a number")
+
+    # the "more" link gives the offset of the next pages, in a URL
+    # parameter of its own for each set of macro arguments
+    offset_param = "offset-" + sha.new(repr(sorted(raw_params.items()))
+                                       .encode(config.charset)).hexdigest()[:8]
+    if arg_limit:
+        try:
+            arg_offset = int(macro.request.form.get(offset_param, arg_offset))
+        except ValueError:
+            pass
+    arg_offset = max(arg_offset, 0)
     if arg_collapse and here_page:
         here_path_part = here_page.split('/')[0:arg_collapse]
     else:
         here_path_part = None
-        
+
+    # output the results directly as HTML, if no wiki markup is involved
+    direct = arg_format == '%s' and arg_link_fmt == DEF_L and \
+             arg_link_hi_fmt == DEF_LHI and \
+             arg_collapsed_fmt == DEF_CF and arg_opened_fmt == DEF_OF and \
+             arg_page_list_format.strip() in ('1. %s', '* %s') and \
+             arg_page_summary_fmt == DEF_PSF and \
+             arg_head_summary_fmt == DEF_PSF and \
+             not (arg_page_summary_rx or
+                  (arg_head_summary_rx and arg_enable_heads)) and \
+             not opt_debug and not 'p' in arg_display_pages_as
+
+    # cached output ?
+    if arg_cache and use_cache and not arg_stream:
+        user = macro.request.user
+        if direct and arg_collapse:
+            # the output only depends on the expanded branch, and on
+            # which link is highlighted: cache one skeleton per branch,
+            # and highlight the here-page link in it
+            key = repr((sorted(raw_params.items()), this_page,
+                        macro.request.page.page_name,
+                        here_path_part, arg_offset,
+                        user.valid and user.name or ''))
+            key = "skeleton-" + sha.new(key.encode(config.charset)).hexdigest()
+            def render_skeleton():
+                # counts and empty lists come back as plain HTML: keep
+                # them as a skeleton without links, so that a skeleton
+                # key always holds a (parts, link_parts) pair
+                result = _execute(macro, text, False, True)
+                if not isinstance(result, tuple):
+                    result = [result], {}
+                return result
+            parts, link_parts = _cached_output(macro.request, key,
+                                               render_skeleton)
+            return "\n%s\n" % _highlight_link(macro.formatter, parts,
+                                               link_parts, here_page)
+        key = repr((sorted(raw_params.items()), this_page,
+                    macro.request.page.page_name, here_page,
+                    arg_offset, user.valid and user.name or ''))
+        key = "output-" + sha.new(key.encode(config.charset)).hexdigest()
+        return _cached_output(macro.request, key,
+                              lambda: _execute(macro, text, False))
+
+    if arg_summary_limit != 'section' and \
+       not isinstance(arg_summary_limit, (int, long)):
+        raise _Error("SummaryScanLimit must be a number or 'section'")
+    if not isinstance(arg_prefetch, (int, long)):
+        raise _Error("Prefetch must be a number")
+    arg_prefetch = min(max(arg_prefetch, 0),
+                       getattr(macro.request.cfg, 'sitecontents_max_threads', 4))
+    if not isinstance(arg_processes, (int, long)):
+        raise _Error("Processes must be a number")
+    arg_processes = min(max(arg_processes, 0),
+                        getattr(macro.request.cfg,
+                                'sitecontents_max_processes', 2))
+    page_summary_rx = head_summary_rx = None
     if arg_page_summary_rx:
-        page_summary_rx = _re_compile(arg_page_summary_rx, 'PageSummaryRx')
-    if arg_head_summary_rx:
-        head_summary_rx = _re_compile(arg_head_summary_rx, 'HeadingSummaryRx')
+        page_summary_rx = _SummaryRx(
+            _re_compile(arg_page_summary_rx, 'PageSummaryRx'),
+            arg_summary_limit)
+    if arg_head_summary_rx and arg_enable_heads:
+        head_summary_rx = _SummaryRx(
+            _re_compile(arg_head_summary_rx, 'HeadingSummaryRx'),
+            arg_summary_limit)
+
+    # with Cache, the hit list is shared with the other requests and
+    # processes through the wiki cache dir, until the edit-log moves;
+    # then, if the page tree journal tells which pages changed since,
+    # only these pages (and their parents) are evaluated again
+    hits = hits_cache = changed_pages = None
+    if arg_cache and len(arg_pages) and not arg_pages.startswith('/'):
+        user = macro.request.user
+        key = repr((arg_pages, this_page, macro.request.page.page_name,
+                    arg_max_path_depth, arg_min_path_depth, arg_collapse,
+                    arg_collapsed_fmt, arg_opened_fmt, here_path_part,
+                    user.valid and user.name or ''))
+        key = "hits-" + sha.new(key.encode(config.charset)).hexdigest()
+        hits_cache = caching.CacheEntry(macro.request, 'sitecontents', key,
+                                        scope='wiki', use_pickle=True)
+        hits_position = _edit_log_position(macro.request)
+        try:
+            cached_position, (cached_serial, cached_hits) = \
+                             hits_cache.content()
+        except (caching.CacheError, TypeError, ValueError):
+            cached_position = cached_serial = cached_hits = None
+
+        tree = _load_tree(macro.request)
+        tree_serial = None
+        if tree is not None and tree['position'] == hits_position:
+            tree_serial = tree['serial']
+
+        # the journal may be recorded at the current position before
+        # all its handlers ran, when pages are changed concurrently: the
+        # hits are only valid for the serial they were computed at too
+        if cached_position == hits_position and cached_serial == tree_serial:
+            hits = cached_hits
+        elif cached_hits is not None and tree_serial is not None:
+            cfg = macro.request.cfg
+            changed_pages = _tree_changes(tree, cached_serial)
+            group_rx = cfg.cache.page_group_regexact
+            if changed_pages is not None and \
+               [name for name in changed_pages if group_rx.search(name)]:
+                # group changes may change the read rights of any page
+                changed_pages = None
+            if cfg.acl_hierarchic or cfg.SecurityPolicy:
+                # the read rights of a page may then depend on other
+                # pages, which the journal does not tell
+                changed_pages = None
+
+    # with a Limit, when the pages are sorted by name and all the hits
+    # are not cached, only look for one hit more than those displayed,
+    # telling whether a "more" link is needed
+    stop_after = 0
+    if arg_limit and not arg_pages_order and not arg_display_counts_f \
+       and hits_cache is None:
+        stop_after = arg_offset + arg_limit + 1
+
+    if hits is not None:
+        # computed by another request
+        pass
 
     # empty page means this page; subpage are also handled
-    if len(arg_pages) == 0 or arg_pages.startswith('/'):
+    elif len(arg_pages) == 0 or arg_pages.startswith('/'):
         arg_pages = this_page + arg_pages
         hits = [arg_pages]
 
     # get a list of pages matching the PageRegex
     else:
-        def name_contains(what):
-            what = what.replace("_", " ")
-            return page.find(what) >= 0
+        classes = _get_page_classes(macro.request)
+        all_pages = _get_all_pages(macro.request)
+        index = _PageIndex(all_pages)
 
-        def name_is(what):
-            what = what.replace("_", " ")
-            return page == what
+        hits = []
+        hits_dict = {}
+        nm_dict = {}
 
-        def name_startswith(what):
-            what = what.replace("_", " ")
-            return page.startswith(what)
+        cfg = macro.request.cfg
 
-        def name_endswith(what):
-            what = what.replace("_", " ")
-            return page.endswith(what)
+        # compile the expression once; the variables are only computed
+        # for the current page when the expression actually uses them
+        code = _compile_pages(arg_pages)
 
-        def name_matches(what):
-            what = what.replace("_", " ")
-            if nm_dict.has_key(what):
-                rx = nm_dict[what]
-            else:
-                rx = _re_compile(what, 'name_matches')
-                nm_dict[what] = rx
-            return rx.search(page) is not None
+        def page_flags(page):
+            if classes.has_key(page):
+                return classes[page]
+            # the page list changed since the table was computed
+            return _classify_page(macro.request,
+                                  _special_page_rxs(cfg), page)
 
-        def contains(what):
-            if hits_dict.has_key(what):
-                hits = hits_dict[what]
-            else:
-                parser = search.QueryParser(regex=1)
-                query = parser.parse_query(what)
-                results = search.searchPages(macro.request, query)
-                hits = [h.page_name for h in results.hits]
-                hits_dict[what] = hits
-            return page in hits
-
-        def name_is_this(what):
-            return name_is(macro.request.page.page_name)
-
-        def name_is_child(what):
-            return name_startswith(this_page + "/")
-
-        def has_children(what):
-            me = what+"/"
-            for p in all_pages:
-                if p.startswith(me): return True
-            return False
+        def select_pages(pages):
 
-        all_pages = _get_all_pages(macro.request)
+            """Returns the hits among PAGES, in the same order"""
 
-        hits = []
-        hits_dict = {}
-        nm_dict = {}
+            def name_contains(what):
+                what = what.replace("_", " ")
+                return page.find(what) >= 0
 
-        cfg = macro.request.cfg
+            def name_is(what):
+                what = what.replace("_", " ")
+                return page == what
+
+            def name_startswith(what):
+                what = what.replace("_", " ")
+                return page.startswith(what)
+
+            def name_endswith(what):
+                what = what.replace("_", " ")
+                return page.endswith(what)
+
+            def name_matches(what):
+                what = what.replace("_", " ")
+                if nm_dict.has_key(what):
+                    rx = nm_dict[what]
+                else:
+                    rx = _re_compile(what, 'name_matches')
+                    nm_dict[what] = rx
+                return rx.search(page) is not None
+
+            def contains(what):
+                if hits_dict.has_key(what):
+                    hits = hits_dict[what]
+                else:
+                    hits = set(contains_hits(macro.request, what,
+                                             arg_contains_index))
+                    hits_dict[what] = hits
+                return page in hits
+
+            def name_is_this(what):
+                return name_is(macro.request.page.page_name)
 
-        for page in all_pages:
-            is_syspage = wikiutil.isSystemPage(macro.request, page)
-            is_special = ( \
-                name_matches(cfg.page_category_regex) or \
-                name_matches(cfg.page_dict_regex) or \
-                name_matches(cfg.page_group_regex) or \
-                name_matches(cfg.page_template_regex) \
-                ) and not "/" in page
-            is_regular = not (is_syspage or is_special)
-
-            locs = {
+            def name_is_child(what):
+                return name_startswith(this_page + "/")
+
+            def is_system():
+                return bool(page_flags(page) & PAGE_SYSTEM)
+
+            def is_regular():
+                return not page_flags(page) & (PAGE_SYSTEM|PAGE_SPECIAL)
+
+            locs = _PagesLocals({
                 # functions:
                 'name_contains': name_contains,
                 'name_is': name_is,
@@ -667,47 +2383,89 @@ def _execute(macro, text):
                 'name_endswith': name_endswith,
                 'name_matches': name_matches,
                 'contains': contains,
-                # vars (for each page we must rebuild this dict for them):
+                }, {
+                # vars (evaluated for the page being examined):
                 'regular': is_regular,
-                'system' : is_syspage,
-                'this_page' : page == this_page,
-                'others' : page != this_page,
-                'all' : True,
-                'this': name_is_this(page),
-                'children': name_is_child(page),
-                'has_child': has_children(page),
-                }
-
-            try:
-                if not eval(arg_pages, {'__builtins__': []}, locs):
+                'system' : is_system,
+                'this_page' : lambda: page == this_page,
+                'others' : lambda: page != this_page,
+                'all' : lambda: True,
+                'this': lambda: name_is_this(page),
+                'children': lambda: name_is_child(page),
+                'has_child': lambda: index.has_children(page),
+                })
+
+            selected = []
+            for page in pages:
+                try:
+                    if not eval(code, {'__builtins__': {}}, locs):
+                        continue
+                except Exception, msg:
+                    raise _Error("""invalid expression for Pages argument: %s
+                    <br>(reason: %s)
+                    """ % (arg_pages, msg))
+
+                depth = page.count("/") + 1
+                if arg_max_path_depth and depth > arg_max_path_depth:
+                    continue
+                if arg_min_path_depth and depth < arg_min_path_depth:
                     continue
-            except Exception, msg:
-                raise _Error("""invalid expression for Pages argument: %s
-                <br>(reason: %s)
-                """ % (arg_pages, msg))
-
-            depth = page.count("/") + 1
-            if arg_max_path_depth and depth > arg_max_path_depth:
-                continue
-            if arg_min_path_depth and depth < arg_min_path_depth:
-                continue
 
-            extra = ""
-            if arg_collapse:
-                page_path_part = page.split('/')[0:arg_collapse]
-                if page_path_part != here_path_part:
-                    if depth>arg_collapse:
-                        continue # hide link
-                if depth==arg_collapse: # mark page if has children
-                    for p in all_pages:
-                        if p.startswith(page+"/"):
+                extra = ""
+                if arg_collapse:
+                    page_path_part = page.split('/')[0:arg_collapse]
+                    if page_path_part != here_path_part:
+                        if depth>arg_collapse:
+                            continue # hide link
+                    if depth==arg_collapse: # mark page if has children
+                        if index.has_children(page):
                             if page_path_part != here_path_part:
                                 extra = arg_collapsed_fmt
                             else:
                                 extra = arg_opened_fmt
-                            break
 
-            hits.append((page, extra))
+                selected.append((page, extra))
+                if stop_after and len(hits) + len(selected) >= stop_after:
+                    break
+
+            return selected
+
+        # only evaluate the expression on the pages its name predicates
+        # and page kinds leave
+        planned = _plan_pages(arg_pages, index, this_page,
+                              macro.request.page.page_name, page_flags)
+
+        pages = all_pages
+        if planned is not None:
+            pages = sorted(planned)
+        if changed_pages is not None:
+            # evaluate the changed pages, and their parents which may
+            # have got or lost children, and keep the other hits
+            affected = set()
+            for name in changed_pages:
+                parts = name.split("/")
+                for i in range(1, len(parts) + 1):
+                    affected.add("/".join(parts[:i]))
+            hits = [hit for hit in cached_hits if not hit[0] in affected]
+            pages = [name for name in pages if name in affected]
+        elif stop_after:
+            # the hits come in sort order: stop as soon as there are
+            # enough of them
+            if planned is None:
+                pages = index.pages
+            if arg_pages_reverse:
+                pages = pages[::-1]
+
+        # contains() searches the whole wiki, which each process would
+        # do again: only the other expressions are worth splitting
+        if _parallel(arg_processes, len(pages)) and not stop_after and \
+           not 'contains' in code.co_names:
+            hits.extend(_parallel_map(select_pages, pages, arg_processes))
+        else:
+            hits.extend(select_pages(pages))
+
+        if hits_cache is not None:
+            _cache_put(hits_cache, hits_position, (tree_serial, hits))
 
     #
     # Build a list of pages
@@ -716,7 +2474,7 @@ def _execute(macro, text):
         hits.sort()
         if arg_pages_reverse: hits.reverse()
     else:
-        # build the list of (regex, rank) pairs, one for each
+        # build the list of (regex text, rank) pairs, one for each
         # PagesOrder term
         order = []
         rank = 0
@@ -724,16 +2482,10 @@ def _execute(macro, text):
 
         # arg_pages_order may either be a list or a page name
         if isinstance(arg_pages_order, basestring):
-            body = Page(macro.request, arg_pages_order).get_raw_body()
-            lines = body.split("\n")
-            lines = [l.strip() for l in lines]
-            lines = [l[1:] for l in lines if l.startswith("*")]
-            lines = [l.strip() for l in lines]
-
-            #lines = [l.replace('.', r'\.') for l in lines]
-            
-            arg_pages_order = lines
-            
+            arg_pages_order = _order_page_terms(macro.request,
+                                                arg_pages_order)
+        arg_pages_order = list(arg_pages_order)
+
         if arg_pages_reverse: arg_pages_order.reverse()
         display_unassigned_header = True
         for term in arg_pages_order:
@@ -746,20 +2498,19 @@ def _execute(macro, text):
                 rank += 1
             else:
                 term = "^%s *(Draft|draft|Internal|internal|)$" % term
-                rx = _re_compile(term, 'PagesOrder')
-                order.append((rx, rank, term))
+                order.append((term, rank))
         unassigned_rank = unassigned_rank or rank + 1
         unassigned_rank += 1 ## leave room for a grouper
 
+        # the regexes are compiled once per process, and combined so
+        # that one search gives the rank of a hit
+        matcher = _order_matcher(order)
+
         # build the list of (rank, hit) pairs, one for each hit
         ordered_hits = []
         has_unassigned = False
         for hit, extra in hits:
-            my_rank = None
-            for rx, rank, term in order:
-                if rx.search(hit) is not None:
-                    my_rank = rank
-                    break
+            my_rank = matcher.rank(hit)
             if my_rank and arg_pages_order_dbg: continue
             if not my_rank and not has_unassigned \
                    and display_unassigned_header \
@@ -775,69 +2526,77 @@ def _execute(macro, text):
         hits = [each[1:3] for each in ordered_hits]
 
     #
-    # Collect info in pages
+    # Wants counts of pages only: no page needs to be read
     #
+    if arg_display_counts_f and not "HEADINGS" in arg_display_counts_f:
+        return arg_display_counts_f % {"PAGES": len(hits), "HEADINGS": 0}
 
-    results = []
+    #
+    # Keep the requested slice of pages
+    #
+    more_offset = None
+    if (arg_limit or arg_offset) and not arg_display_counts_f:
+        # the <Unordered> grouper is not a page: it is not counted, and
+        # is kept only before the unordered pages that are kept
+        pages_ix = [ix for ix, (page_name, extra) in enumerate(hits)
+                    if page_name != "<Unordered>"]
+        end = len(pages_ix)
+        if arg_limit and end > arg_offset + arg_limit:
+            end = more_offset = arg_offset + arg_limit
+        kept = pages_ix[arg_offset:end]
+        if kept:
+            start = kept[0]
+            if start and hits[start-1][0] == "<Unordered>":
+                start -= 1
+            hits = hits[start:kept[-1]+1]
+        else:
+            hits = []
 
-    for page_name, extra in hits:
-        # treat each page ...
+    #
+    # Collect info in pages
+    #
 
-        # get the body
-        body = Page(macro.request, page_name).get_raw_body()
+    results = []
 
-        # get the page summary
-        page_summary = None
-        if arg_page_summary_rx:
-            txt = _array2str(re.findall(page_summary_rx, body))
-            if txt: txt = txt[0]
-            page_summary = txt
-
-        #  easier than regex:
-        matches = ("\n"+body).split("\n=")
-        #  anything ?
-        if len(matches) < 2:
-            matches = []
-        else:
-            #  remove 1st part and restore leading '=' of each heading
-            matches = ["=" + each for each in matches[1:]]
+    # headings and summaries come from the persistent index, which
+    # only reads the pages it has no up to date entry for
+    index = None
+    if arg_enable_heads or page_summary_rx:
+        index = _HeadingIndex(macro.request)
+        if _parallel(arg_processes, len(hits)):
+            index.update([page_name for page_name, extra in hits],
+                         page_summary_rx, head_summary_rx, arg_processes)
+        if arg_prefetch:
+            index.prefetch([page_name for page_name, extra in hits],
+                           page_summary_rx, head_summary_rx, arg_prefetch)
 
-        heads = []
-        if arg_enable_heads:
-            # analyze the headings
-            min_depth = None
-            max_depth = None
-            for match in matches:
-                # split first line (heading) and others
-                first_line, text = (match+"\n").split("\n", 1)
-                if not first_line.endswith('='): continue
-                text = text.strip('\n')
-                # parse first line to get title and depth (number of '=')
-                gd = HEAD_RX.search(first_line).groupdict()
-                eqs = gd.get('eq', '=')
-                head_title = gd.get('title', '<invalid>')
-                depth = len(eqs)
-                if min_depth is None or depth < min_depth: min_depth = depth
-                if max_depth is None or depth > max_depth: max_depth = depth
-                # get the heading summary
-                head_summary = None
-                if arg_head_summary_rx:
-                    txt = _array2str(re.findall(head_summary_rx, text))
-                    if txt: txt = txt[0]
-                    head_summary = txt
-                # remember heading
-                heads.append([depth, head_title.strip(), head_summary])
-
-            # re-align depth
-            for head in heads: head[0] -= min_depth-1
-            # filter for depth to be in-range
-            def in_range(d):
-                return (arg_min_head_depth==0 or d>=arg_min_head_depth) and \
-                       (arg_max_head_depth==0 or d<=arg_max_head_depth)
-            heads = [head for head in heads if in_range(head[0])]
-
-        # collect all headings and contents
-        results.append((page_name, page_summary, heads, extra))
+    try:
+        for page_name, extra in hits:
+            # treat each page ...
+            page_summary = None
+            all_heads = heads = []
+            if index:
+                page_summary, all_heads = index.lookup(page_name,
+                                                       page_summary_rx,
+                                                       head_summary_rx)
+
+            if arg_enable_heads and all_heads:
+                # re-align depth
+                min_depth = min([head[0] for head in all_heads])
+                heads = [[depth-(min_depth-1), title, anchor, summary]
+                         for depth, title, anchor, summary in all_heads]
+                # filter for depth to be in-range
+                def in_range(d):
+                    return (arg_min_head_depth==0 or
+                            d>=arg_min_head_depth) and \
+                           (arg_max_head_depth==0 or d<=arg_max_head_depth)
+                heads = [head for head in heads if in_range(head[0])]
+
+            # collect all headings and contents
+            results.append((page_name, page_summary, heads, extra))
+    finally:
+        if index:
+            index.save()
 
 
     #
@@ -871,11 +2630,151 @@ def _execute(macro, text):
             if start_neg_offset == 0 or l<start_neg_offset:
                 start_neg_offset = l
 
+    #
+    # Link to the next pages
+    #
+    f = macro.formatter
+    more_html = ""
+    if more_offset is not None:
+        querystr = {offset_param: more_offset}
+        if here_page:
+            querystr['here'] = here_page
+        more_html = "\n" + f.paragraph(1) + \
+                    f.pagelink(1, this_page, querystr=querystr) + \
+                    f.text("more...") + f.pagelink(0, this_page) + \
+                    f.paragraph(0) + "\n"
+
+    #
+    # Output the results directly as HTML
+    #
+    html_lists = _HtmlList(f)
+    html_parts = []
+    link_parts = {} # page name -> index of its link in html_parts
+    list_indent = len(arg_page_list_format) - \
+                  len(arg_page_list_format.lstrip())
+    list_numbered = arg_page_list_format.strip().startswith('1.')
+
+    def html_link(page_name, display, anchor=None):
+        if anchor:
+            link = f.pagelink(1, page_name, anchor=anchor.lstrip('#'))
+        else:
+            link = f.pagelink(1, page_name)
+        return link + f.text(display) + f.pagelink(0, page_name)
+
+    def html_page(page_name, page_path, last_page_path, page_display_name,
+                  level, display_pages_as, heads, extra):
+        out = []
+        link_ix = None
+        marker = ""
+        if extra:
+            marker = f.text(" ") + f.small(1) + f.text("[+]") + \
+                     f.small(0) + f.text(" ")
+
+        if display_pages_as == "h" or display_pages_as == "H":
+            # look how this page and last page are common
+            ix = 0
+            for i in range(min(len(last_page_path), len(page_path))):
+                if last_page_path[i] == page_path[i]: ix +=1
+                else: break
+            title = split_title('/'.join(page_path[ix:]), True)
+
+            # heading for page name, then marker and page link
+            depth = min(1+ix+arg_page_offset, 5)
+            out.append(html_lists.close())
+            out.append(f.heading(1, depth, id=title) + f.text(title) +
+                       f.heading(0, depth))
+            para = marker
+            if display_pages_as == "h" and not arg_nolink:
+                para += html_link(page_name,
+                                  split_title(page_name, enable_split))
+                para += marker
+            out.append(para)
+
+        elif display_pages_as == "l":
+            # insert missing levels as non-clickable items
+            for i in range(len(page_path)-1):
+                if i<len(last_page_path) and page_path[i]==last_page_path[i]:
+                    continue
+                out.append(html_lists.item(
+                    i + 1 + list_indent, list_numbered,
+                    f.text(split_title(page_path[i], True))))
+
+            # page as list item
+            if arg_nolink:
+                link = f.text(page_display_name)
+            else:
+                if arg_structured:
+                    page_display_name = page_name.split("/")[-1]
+                link = html_link(page_name,
+                                 split_title(page_display_name, enable_split))
+            # the here-page is highlighted afterwards, the index of its
+            # link in OUT being returned
+            out.append(html_lists.item(level + list_indent, list_numbered,
+                                       ""))
+            link_ix = len(out)
+            out.append(link)
+            out.append(marker)
+
+        if arg_display_heads:
+            # headings
+            for depth, head_title, anchor, head_summary in heads:
+                title = split_title(head_title, enable_split)
+                if arg_nolink:
+                    link = f.text(title)
+                else:
+                    link = html_link(page_name, title, anchor)
+                out.append(html_lists.item(2*depth + 1, True, link + marker))
+
+        return out, link_ix
+
     #
     # Output the results
     #
     wiki_text = ""
     wiki_text_prefix = []
+    # text of whole pages is not appended to wiki_text, which would be
+    # copied again for each page, but kept aside
+    wiki_chunks = []
+
+    # in Stream mode, or with Cache, pages displayed as 'p' are rendered
+    # one by one, and the HTML of each is sent right away (Stream) or
+    # kept aside to be stitched (Cache); the wiki text pending between
+    # them is rendered on its own
+    per_page = (arg_stream or arg_cache) and 'p' in arg_display_pages_as
+    per_page_started = False
+    html_pieces = []
+
+    def write_html(html):
+        if arg_stream:
+            macro.request.write(html)
+        else:
+            html_pieces.append(html)
+
+    def write_wiki(text):
+        if not text.strip(): return
+        if opt_debug:
+            write_html("<pre>%s</pre>\n" % text.replace(
+                "&", "&amp;").replace("<", "&lt;"))
+        write_html("\n%s\n" % _format(text, macro.request))
+
+    def page_html(page_name, levels):
+        def render():
+            body = Page(macro.request, page_name).get_raw_body()
+            text = _one_page_text(page_name, body, levels)
+            del body
+            html = "\n%s\n" % _format(text, macro.request)
+            if opt_debug:
+                html = "<pre>%s</pre>\n" % text.replace(
+                    "&", "&amp;").replace("<", "&lt;") + html
+            return html
+        if arg_cache and not opt_debug:
+            return _cached_page_html(macro.request, page_name, this_page,
+                                     len(levels), render)
+        return render()
+
+    if per_page:
+        fmt_head, fmt_tail = (arg_format % u"\0").split(u"\0")
+        wiki_text = fmt_head
 
     last_page_path = []
         
@@ -899,6 +2798,16 @@ def _execute(macro, text):
         else:
             display_pages_as = arg_display_pages_as[level]
 
+        if direct:
+            out, link_ix = html_page(page_name, page_path, last_page_path,
+                                     page_display_name, level,
+                                     display_pages_as, heads, extra)
+            if link_ix is not None:
+                link_parts[page_name] = len(html_parts) + link_ix
+            html_parts.extend(out)
+            last_page_path = page_path
+            continue
+
         if display_pages_as == "h" or display_pages_as == "H":
             # look how this page and last page are common
             ix = 0
@@ -921,46 +2830,30 @@ def _execute(macro, text):
 
         elif display_pages_as == "p":
             if not page_name.lower().endswith("draft"):
-                body = Page(macro.request, page_name).get_raw_body()
                 levels = page_name.split("/")[start_neg_offset:]
-                h = "=" * len(levels)
 
                 # schedule a prefix
                 pf = "<<TableOfContents(5)>>"
                 if not pf in wiki_text_prefix:
                     wiki_text_prefix.append(pf)
-                
-                # adjust attachments
-                def replacer(m):
-                    s = m.group(0)
-                    return s[:13] + page_name + "/" + s[13:]
-                rx = re.compile("\{\{attachment:[^/}]+?}}")
-                body = rx.sub(replacer, body)
-                rx = re.compile("\[\[attachment:[^/}]+?]]")
-                body = rx.sub(replacer, body)
-    
-                # adjust headings
-                rx = re.compile("^(=.*=) *$", re.M)
-                body = rx.sub(h + r'\1' + h, body)
-    
-                # remove TOCs
-                rx = re.compile("<<TableOfContents.*?>>")
-                body = rx.sub("", body)
-    
-                # remove comments
-                body = body.split("\n")
-                body = [ l for l in body if not l.startswith("#") ]
-                body = "\n".join(body)
-    
+
                 # add this page
-                wiki_text += "<<BR>>" * 2 + "\n"
-                #wiki_text += "----------\n"
-                #wiki_text += "''(Page [[%s|%s]])''\n" % (page_name, page_name)
-                #wiki_text += "<<BR>>" * 3 + "\n"
-    
-                ttl = split_title(levels[-1], True)
-                wiki_text += "%s [%s] %s\n" % (h, ttl, h)
-                wiki_text += body
+                if per_page:
+                    # render what is pending, then this page
+                    if not per_page_started:
+                        wiki_text = u"\n".join(wiki_text_prefix) + \
+                                    u"\n" + wiki_text
+                    per_page_started = True
+                    write_wiki(wiki_text)
+                    write_html(page_html(page_name, levels))
+                    wiki_text = ""
+                else:
+                    body = Page(macro.request, page_name).get_raw_body()
+                    wiki_chunks.append(wiki_text)
+                    wiki_chunks.append(_one_page_text(page_name, body,
+                                                      levels))
+                    wiki_text = ""
+                    del body
 
         elif display_pages_as == "l":
             # insert missing levels as non-clickable items
@@ -1040,22 +2933,9 @@ def _execute(macro, text):
 
         if arg_display_heads:
             # headings
-            anchors = []
-            for depth, head_title, head_summary in heads:
-                # generate anchor
-                s = page_name + head_title
-                s = s. encode(config.charset)
-                anchor = "#head-" + sha.new(s).hexdigest()
-                # store anchor to count similar ones
-                anchors.append(anchor)
-                n = anchors.count(anchor)
-                # add index if needed
-                if n>1:
-                    unique_anchor = anchor + "-%d" % n
-                else:
-                    unique_anchor = anchor
+            for depth, head_title, anchor, head_summary in heads:
                 # link
-                l = page_name + unique_anchor
+                l = page_name + anchor
                 if arg_nolink:
                     link = split_title(head_title)
                 else:
@@ -1071,7 +2951,22 @@ def _execute(macro, text):
         # ready for next page
         last_page_path = page_path
 
+    if direct:
+        html_parts.append(html_lists.close())
+        html_parts.append(more_html)
+        if skeleton:
+            return html_parts, link_parts
+        return debug_html + "\n%s\n" % _highlight_link(f, html_parts,
+                                                        link_parts, here_page)
+
+    if per_page:
+        write_wiki(wiki_text + fmt_tail)
+        write_html(more_html)
+        return debug_html + "".join(html_pieces)
+
     # ready to output
+    wiki_chunks.append(wiki_text)
+    wiki_text = "".join(wiki_chunks)
     if wiki_text.strip():
         wiki_text = arg_format % wiki_text
     if wiki_text_prefix:
@@ -1085,6 +2980,6 @@ def _execute(macro, text):
     # convert wiki text to html
     html += "\n%s\n" % _format(wiki_text, macro.request)
 
-    return debug_html + html
+    return debug_html + html + more_html
 
 # end